@@ -0,0 +1,82 @@
+from numstat import GITLINK_MODE
+
+## Object sizes in bulk
+
+# Objects asked for before the answers are read back, which keeps both pipes
+# from filling up
+BATCH_SIZE = 256
+
+# Sizes kept before the cache is dropped
+CACHE_LIMIT = 100_000
+
+class BatchCheck:
+    """Looks up blob sizes through one long-lived `git cat-file --batch-check`."""
+    def __init__(self, repo):
+        self.proc = repo.popen("cat-file", "--batch-check", stdin=True)
+        self.cache = {}
+
+    def sizes(self, oids):
+        """Return the size of every object in OIDS, 0 for None."""
+        wanted = {oid for oid in oids if oid is not None}
+        if len(self.cache) + len(wanted - self.cache.keys()) > CACHE_LIMIT:
+            # Drop the cache before looking up what is missing from it, so
+            # the sizes this call needs are all looked up again
+            self.cache.clear()
+        missing = [oid for oid in wanted if oid not in self.cache]
+
+        for i in range(0, len(missing), BATCH_SIZE):
+            batch = missing[i:i + BATCH_SIZE]
+            self.proc.stdin.write("".join(oid + "\n" for oid in batch).encode("ascii"))
+            self.proc.stdin.flush()
+            for oid in batch:
+                # "<oid> <type> <size>", or "<oid> missing"
+                answer = self.proc.stdout.readline().decode("ascii").split()
+                if len(answer) != 3:
+                    raise RuntimeError("git cat-file cannot find {}".format(oid))
+                self.cache[oid] = int(answer[2])
+
+        return [0 if oid is None else self.cache[oid] for oid in oids]
+
+    def add_sizes(self, stat):
+        """Fill in the blob sizes of every file of STAT."""
+        if stat.files is None:
+            return stat
+
+        # A submodule is a commit of another repository, counted as size 0
+        oids = [
+            None if mode == GITLINK_MODE else oid
+            for files in stat.files for f in files
+            for oid, mode in ((f.old_blob, f.old_mode), (f.new_blob, f.new_mode))
+        ]
+        sizes = iter(self.sizes(oids))
+        return stat._replace(files=tuple(
+            [f._replace(old_size=next(sizes), new_size=next(sizes)) for f in files]
+            for files in stat.files
+        ))
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.wait()
+
+## Blob contents
+
+class CatFile:
+    """Reads objects through one long-lived `git cat-file --batch`."""
+    def __init__(self, repo):
+        self.proc = repo.popen("cat-file", "--batch", stdin=True)
+
+    def read(self, oid):
+        """Return the contents of the object OID."""
+        self.proc.stdin.write(oid.encode("ascii") + b"\n")
+        self.proc.stdin.flush()
+        # "<oid> <type> <size>\n<contents>\n", or "<oid> missing\n"
+        header = self.proc.stdout.readline().split()
+        if len(header) != 3:
+            raise RuntimeError("git cat-file cannot find {}".format(oid))
+        data = self.proc.stdout.read(int(header[2]))
+        self.proc.stdout.read(1)
+        return data
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.wait()
@@ -0,0 +1,113 @@
+import csv
+import logging
+import os
+
+log = logging.getLogger(__name__)
+
+## Checkpoints for incremental and resumable commitdiff runs
+#
+# Next to the output CSV we keep "<output>.checkpoint" with one line
+# "<hexsha> <offset>" for every commit that has been handled, where <offset>
+# is the size of the CSV once the rows of that commit were written. Lines are
+# written in batches after the CSV is flushed, so the checkpoint never claims
+# rows that are not on disk, and a resumed run cuts the CSV back to the last
+# offset before it appends. Commits without rows are recorded too, so they
+# are not visited again.
+
+# Commits between two checkpoints
+CHECKPOINT_EVERY = 100
+
+def checkpoint_path(output):
+    return output + ".checkpoint"
+
+def load_checkpoint(output):
+    """Return the commits already covered by OUTPUT and the size of its complete part.
+
+    Without a checkpoint, or with one that does not fit the CSV (which was
+    rewritten after it), the commits are collected from the CSV itself. The
+    size is None when there is nothing to continue from.
+    """
+    if not os.path.exists(output):
+        return set(), None
+
+    checkpoint = read_checkpoint(output)
+    if checkpoint is not None:
+        return checkpoint
+
+    done = set()
+    offset = None
+    with open(output, newline="") as f:
+        reader = csv.reader(f)
+        if next(reader, None) is not None:
+            done = {row[0] for row in reader}
+            offset = os.path.getsize(output)
+    return done, offset
+
+def read_checkpoint(output):
+    """Return the commits and offset the checkpoint of OUTPUT records, or None if it has none that fits."""
+    path = checkpoint_path(output)
+    if not os.path.exists(path):
+        return None
+
+    done = set()
+    offset = None
+    with open(path) as f:
+        for line in f:
+            # The last line may be torn by a crash
+            if not line.endswith("\n"):
+                break
+            hexsha, size = line.split()
+            done.add(hexsha)
+            offset = int(size)
+    if offset is None:
+        return done, offset
+
+    # The offset has to end a row of the CSV. A crashed run leaves rows
+    # past it, written after the checkpoint, but a CSV that ends right there
+    # and is newer than the checkpoint was written over since.
+    csv_stat = os.stat(output)
+    if offset > csv_stat.st_size or (offset == csv_stat.st_size and csv_stat.st_mtime_ns > os.stat(path).st_mtime_ns) or not ends_row(output, offset):
+        log.warning("%s does not fit its checkpoint, reading the commits it covers from it instead", output)
+        return None
+    return done, offset
+
+def ends_row(output, offset):
+    if offset == 0:
+        return True
+    with open(output, "rb") as f:
+        f.seek(offset - 1)
+        return f.read(1) == b"\n"
+
+class Checkpoint:
+    """Records the commits whose rows have been written to OUTPUT_FILE.
+
+    The checkpoint file is started over, with the commits in `done` (those
+    already covered by the output) at the current size of the output.
+    """
+    def __init__(self, output_file, path, done=()):
+        self.output_file = output_file
+
+        # Replace the old checkpoint in one step, so a crash right now cannot lose it
+        offset = os.fstat(output_file.fileno()).st_size
+        with open(path + ".tmp", "w") as f:
+            f.write("".join("{} {}\n".format(hexsha, offset) for hexsha in done))
+        os.replace(path + ".tmp", path)
+
+        self.file = open(path, "a")
+        self.pending = []
+
+    def done(self, hexsha):
+        self.pending.append(hexsha)
+        if len(self.pending) >= CHECKPOINT_EVERY:
+            self.flush()
+
+    def flush(self):
+        self.output_file.flush()
+        offset = os.fstat(self.output_file.fileno()).st_size
+        self.file.write("".join("{} {}\n".format(hexsha, offset) for hexsha in self.pending))
+        self.file.flush()
+        self.pending = []
+
+    def close(self):
+        self.flush()
+        self.file.close()
@@ -0,0 +1,251 @@
+import array
+import os
+import struct
+import zipfile
+
+import numpy as np
+
+from numstat import typed_counts
+
+## Columnar commitdiff output
+#
+# The rows of a commitdiff run, stored column by column instead of as CSV:
+# commit and blob ids as 20 raw bytes, counts as int32 with binary files
+# flagged in a bool column (and counted as 0), and filenames
+# dictionary-encoded, as int32 codes into a table of the distinct names (which
+# the old and new paths share, "" standing for a missing file). An output
+# ending in ".npz" is an uncompressed numpy archive, whose arrays `load` maps
+# into memory instead of reading them; one ending in ".feather" is an
+# uncompressed Feather file, which needs pyarrow.
+
+SUFFIXES = (".npz", ".feather")
+
+# The codes of the filenames (and paths) index this table
+FILENAMES = "filenames"
+
+# The columns holding codes into FILENAMES
+NAME_COLUMNS = ("filename", "old_path", "new_path")
+
+def is_columnar(path):
+    return path.endswith(SUFFIXES)
+
+def oid_bytes(oid):
+    # Missing blobs are all zeros, like git's null id
+    return bytes(20) if oid is None else bytes.fromhex(oid)
+
+class ColumnarOutput:
+    """Collects the rows of one output, and writes them as columns when closed."""
+    def __init__(self, path, sizes=False, paths=False):
+        if path.endswith(".feather"):
+            # Fail before the run rather than after it
+            import pyarrow  # noqa: F401
+
+        self.path = path
+        self.sizes = sizes
+        self.paths = paths
+        # Nothing is ever continued, see --incremental
+        self.done = set()
+
+        self.commits = bytearray()
+        self.num_additions = array.array("i")
+        self.num_deletions = array.array("i")
+        self.binary = bytearray()
+        self.filenames = {}
+        self.filename_codes = array.array("i")
+        if sizes:
+            self.old_blobs = bytearray()
+            self.new_blobs = bytearray()
+            self.old_sizes = array.array("q")
+            self.new_sizes = array.array("q")
+        if paths:
+            self.old_paths = array.array("i")
+            self.new_paths = array.array("i")
+
+    def write(self, stat, files):
+        # Root commits (and merge commits, unless asked for) are not diffed
+        if files is None:
+            return
+        commit = bytes.fromhex(stat.hexsha)
+        for f in files:
+            self.commits += commit
+            num_additions, num_deletions, binary = typed_counts(f)
+            self.num_additions.append(num_additions)
+            self.num_deletions.append(num_deletions)
+            self.binary.append(binary)
+            self.filename_codes.append(self.code(f.filename))
+            if self.sizes:
+                self.old_blobs += oid_bytes(f.old_blob)
+                self.new_blobs += oid_bytes(f.new_blob)
+                self.old_sizes.append(f.old_size)
+                self.new_sizes.append(f.new_size)
+            if self.paths:
+                self.old_paths.append(self.code(f.old_path or ""))
+                self.new_paths.append(self.code(f.new_path or ""))
+
+    def code(self, name):
+        return self.filenames.setdefault(name, len(self.filenames))
+
+    def columns(self):
+        columns = {
+            "commit_hash": np.frombuffer(self.commits, dtype="S20"),
+            "num_additions": np.frombuffer(self.num_additions, dtype=np.int32),
+            "num_deletions": np.frombuffer(self.num_deletions, dtype=np.int32),
+            "binary": np.frombuffer(self.binary, dtype=np.bool_),
+            "filename": np.frombuffer(self.filename_codes, dtype=np.int32),
+        }
+        if self.sizes:
+            columns.update(
+                old_blob=np.frombuffer(self.old_blobs, dtype="S20"),
+                new_blob=np.frombuffer(self.new_blobs, dtype="S20"),
+                old_size=np.frombuffer(self.old_sizes, dtype=np.int64),
+                new_size=np.frombuffer(self.new_sizes, dtype=np.int64),
+            )
+        if self.paths:
+            columns.update(
+                old_path=np.frombuffer(self.old_paths, dtype=np.int32),
+                new_path=np.frombuffer(self.new_paths, dtype=np.int32),
+            )
+        return columns
+
+    def close(self):
+        columns = self.columns()
+        # Keep the table of names, in code order
+        filenames = np.array(list(self.filenames), dtype=str)
+
+        tmp = "{}.{}.tmp{}".format(self.path, os.getpid(), os.path.splitext(self.path)[1])
+        if self.path.endswith(".feather"):
+            write_feather(tmp, columns, filenames)
+        else:
+            np.savez(tmp, **columns, **{FILENAMES: filenames})
+        os.replace(tmp, self.path)
+
+def write_feather(path, columns, filenames):
+    import pyarrow as pa
+    import pyarrow.feather as feather
+
+    dictionary = pa.array(filenames, pa.string())
+    arrays = {}
+    for name, column in columns.items():
+        if name in NAME_COLUMNS:
+            arrays[name] = pa.DictionaryArray.from_arrays(column, dictionary)
+        elif column.dtype.kind == "S":
+            arrays[name] = pa.FixedSizeBinaryArray.from_buffers(pa.binary(20), len(column), [None, pa.py_buffer(column.tobytes())])
+        else:
+            arrays[name] = pa.array(column)
+    feather.write_feather(pa.table(arrays), path, compression="uncompressed")
+
+## Loading
+
+def load(path, mmap=True):
+    """Load the columns of a columnar output as a dict of numpy arrays.
+
+    The filenames and paths are codes into the "filenames" array. With MMAP the
+    arrays of a .npz map the file instead of reading it.
+    """
+    if path.endswith(".feather"):
+        return load_feather(path, mmap)
+    if mmap:
+        return mmap_npz(path)
+    with np.load(path) as npz:
+        return {name: npz[name] for name in npz.files}
+
+def mmap_npz(path):
+    # np.load cannot map the members of an archive, but those of an
+    # uncompressed one are stored as-is, after a local header
+    columns = {}
+    with zipfile.ZipFile(path) as archive, open(path, "rb") as f:
+        for info in archive.infolist():
+            name = info.filename.removesuffix(".npy")
+            if info.compress_type != zipfile.ZIP_STORED:
+                columns[name] = np.load(archive.open(info))
+                continue
+            f.seek(info.header_offset + 26)
+            name_length, extra_length = struct.unpack("<HH", f.read(4))
+            f.seek(info.header_offset + 30 + name_length + extra_length)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            if dtype.hasobject or not all(shape):
+                columns[name] = np.load(archive.open(info))
+                continue
+            columns[name] = np.memmap(f, dtype=dtype, mode="r", offset=f.tell(), shape=shape, order="F" if fortran_order else "C")
+    return columns
+
+def load_feather(path, mmap=True):
+    import pyarrow.feather as feather
+
+    table = feather.read_table(path, memory_map=mmap)
+    columns = {}
+    for name in table.column_names:
+        column = table.column(name).combine_chunks()
+        if name in NAME_COLUMNS:
+            columns[name] = column.indices.to_numpy(zero_copy_only=False)
+            columns[FILENAMES] = column.dictionary.to_numpy(zero_copy_only=False).astype(str)
+        elif name.endswith(("_hash", "_blob")):
+            columns[name] = np.frombuffer(column.buffers()[1], dtype="S20", count=len(column), offset=column.offset * 20)
+        else:
+            # Bools are bits in arrow, so they are copied into bytes
+            columns[name] = column.to_numpy(zero_copy_only=False)
+    return columns
+
+def load_frame(path, mmap=True):
+    """Load a commitdiff output as a pandas DataFrame, with the columns of a --typed CSV.
+
+    Commit and blob ids, filenames and paths are categoricals: the hex ids and
+    names are only built once for each distinct value. CSV outputs are read
+    with fixed dtypes too; "-" counts of untyped ones become a binary column.
+    """
+    import pandas as pd
+
+    if not is_columnar(path):
+        return load_csv(path)
+    columns = load(path, mmap)
+    filenames = columns.pop(FILENAMES)
+    frame = {}
+    for name, column in columns.items():
+        if name in NAME_COLUMNS:
+            frame[name] = pd.Categorical.from_codes(column, filenames)
+        elif column.dtype.kind == "S":
+            values, codes = np.unique(column, return_inverse=True)
+            # numpy drops the trailing zero bytes of every value, and missing blobs are empty
+            frame[name] = pd.Categorical.from_codes(codes, [value.ljust(20, b"\0").hex() if value else "" for value in values.tolist()])
+        else:
+            frame[name] = column
+    return pd.DataFrame(frame)
+
+# The dtypes of the CSV columns, by name
+CSV_DTYPES = {
+    "commit_hash": "category",
+    "num_additions": np.int32,
+    "num_deletions": np.int32,
+    "binary": np.bool_,
+    "filename": "category",
+    "old_blob": "category",
+    "new_blob": "category",
+    "old_size": np.int64,
+    "new_size": np.int64,
+    "old_path": "category",
+    "new_path": "category",
+}
+
+def load_csv(path):
+    import pandas as pd
+
+    with open(path, newline="") as f:
+        header = f.readline().rstrip("\r\n").split(",")
+    dtypes = {name: CSV_DTYPES.get(name, object) for name in header}
+    if "binary" in header:
+        return pd.read_csv(path, dtype=dtypes, keep_default_na=False)
+
+    # Untyped: binary files have "-" counts
+    dtypes.update(num_additions="category", num_deletions="category")
+    frame = pd.read_csv(path, dtype=dtypes, keep_default_na=False)
+    binary = (frame["num_additions"] == "-").to_numpy()
+    for name in ("num_additions", "num_deletions"):
+        values = frame[name].cat.categories.to_numpy(dtype=object)
+        counts = np.array([0 if value == "-" else int(value) for value in values], dtype=np.int32)
+        frame[name] = counts[frame[name].cat.codes.to_numpy()] if len(values) else np.zeros(len(frame), dtype=np.int32)
+    frame.insert(3, "binary", binary)
+    return frame
@@ -1,31 +1,318 @@
+import contextlib
 import csv
-import git
 import click
+import heapq
+import json
+import logging
+import os
+import time
 from tqdm import tqdm
 
+from catfile import BatchCheck
+from checkpoint import Checkpoint, checkpoint_path, load_checkpoint
+from columnar import ColumnarOutput, is_columnar
+from numstat import ENGINES, MERGE_MODES, VARIANTS, count_commits, iter_all, iter_hexshas, make_pathspecs, make_rename_flags, parallel_engine, timed, typed_counts
+from paircache import DEFAULT_LIMIT
+from plumbing import Repo
+
+log = logging.getLogger(__name__)
+
+class CsvOutput:
+    """One output CSV, with its checkpoint.
+
+    With `incremental`, the commits a previous run already covered are kept
+    in `done`, and any rows written after its last checkpoint are cut off.
+    With `sizes`, the blob ids and sizes before and after the change are
+    written as well, and with `paths` the paths before and after it. With
+    `typed`, binary files get counts of 0 and a 1 in the binary column
+    instead of "-", so every column holds a single type.
+    """
+    def __init__(self, path, incremental=False, sizes=False, paths=False, typed=False):
+        self.path = path
+        self.sizes = sizes
+        self.paths = paths
+        self.typed = typed
+
+        header = ["commit_hash", "num_additions", "num_deletions", "filename"]
+        if typed:
+            header.insert(3, "binary")
+        if sizes:
+            header += ["old_blob", "new_blob", "old_size", "new_size"]
+        if paths:
+            header += ["old_path", "new_path"]
+
+        done, offset = load_checkpoint(path) if incremental else (set(), None)
+        if offset is None:
+            self.done = set()
+        else:
+            # The rows appended have to match the columns already there
+            with open(path, newline="") as f:
+                columns = next(csv.reader(f), [])
+            if columns != header:
+                raise click.UsageError("{} has the columns {}, not {}; give the same options as the run that wrote it".format(path, ",".join(columns), ",".join(header)))
+            self.done = done
+            os.truncate(path, offset)
+            log.info("Continuing %s, which covers %d commits", path, len(done))
+
+        self.file = open(path, "w" if offset is None else "a")
+        self.writer = csv.writer(self.file)
+        self.checkpoint = Checkpoint(self.file, checkpoint_path(path), self.done)
+
+        # Write the header row
+        if offset is None:
+            self.writer.writerow(header)
+
+    def write(self, stat, files):
+        if stat.hexsha in self.done:
+            return
+        # Root commits (and merge commits, unless asked for) are not diffed
+        if files is not None:
+            for f in files:
+                if self.typed:
+                    num_additions, num_deletions, binary = typed_counts(f)
+                    row = [stat.hexsha, num_additions, num_deletions, int(binary), f.filename]
+                else:
+                    row = [stat.hexsha, f.num_additions, f.num_deletions, f.filename]
+                if self.sizes:
+                    row += [f.old_blob or "", f.new_blob or "", f.old_size, f.new_size]
+                if self.paths:
+                    row += [f.old_path or "", f.new_path or ""]
+                self.writer.writerow(row)
+        self.checkpoint.done(stat.hexsha)
+
+    def close(self):
+        self.checkpoint.close()
+        self.file.close()
+
+def open_output(path, incremental=False, sizes=False, paths=False, typed=False):
+    """Open OUTPUT as a CSV, or as columns for a .npz or .feather path (which are always typed)."""
+    if is_columnar(path):
+        if incremental:
+            raise click.UsageError("--incremental only works with CSV outputs, not {}".format(path))
+        return ColumnarOutput(path, sizes, paths)
+    return CsvOutput(path, incremental, sizes, paths, typed)
+
+class RenameTimings:
+    """A CSV with the time git spent detecting renames in every diffed commit."""
+    def __init__(self, path):
+        self.file = open(path, "w")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(["commit_hash", "num_files", "num_renames", "rename_seconds"])
+        self.total = 0.0
+
+    def write(self, stat):
+        if stat.files is None:
+            return
+        # Renames and copies are the files shown as "old => new"
+        files = stat.files[0]
+        self.writer.writerow([stat.hexsha, len(files), sum(" => " in f.filename for f in files), "{:.6f}".format(stat.rename_time)])
+        self.total += stat.rename_time
+
+    def close(self):
+        self.file.close()
+        log.info("git spent %.1fs detecting renames", self.total)
+
+def read_commits(commit_list=None, mapping=None, column="to"):
+    """Read the commits to diff, one per line of COMMIT_LIST or from COLUMN of the MAPPING CSV.
+
+    Duplicates are dropped, keeping the first occurrence.
+    """
+    commits = []
+    if commit_list is not None:
+        with open(commit_list) as f:
+            commits += [line.strip() for line in f]
+    if mapping is not None:
+        with open(mapping, newline="") as f:
+            reader = csv.DictReader(f)
+            if column not in (reader.fieldnames or ()):
+                raise click.BadParameter("{} has no column {!r}".format(mapping, column), param_hint="--column")
+            commits += [row[column].strip() for row in reader]
+    return list(dict.fromkeys(hexsha for hexsha in commits if hexsha))
+
+def list_all(repo, refs_path=None):
+    """List the commits of every ref, once each, writing the refs containing them to the REFS_PATH CSV."""
+    commits = []
+    with contextlib.ExitStack() as stack:
+        writer = None
+        if refs_path is not None:
+            writer = csv.writer(stack.enter_context(open(refs_path, "w")))
+            writer.writerow(["commit_hash", "refs"])
+        for hexsha, refs in iter_all(repo):
+            commits.append(hexsha)
+            if writer is not None:
+                writer.writerow([hexsha, " ".join(sorted(refs))])
+    return commits
+
+# Commits listed in the --stats file as the slowest
+SLOWEST = 20
+
+class RunStats:
+    """Collects the throughput of a run, written as JSON by close().
+
+    The time spent in git is the time spent waiting for its output (see
+    GitStats); the rest of the run is Python. With several jobs the time
+    the workers waited for git is added up, so it can exceed the run.
+    """
+    def __init__(self, path, repo, engine, jobs):
+        self.path = path
+        self.repo = repo
+        self.engine = engine
+        self.jobs = jobs
+        self.start = time.perf_counter()
+        self.git_start = repo.stats.snapshot()
+        self.commits = 0
+        self.diffed = 0
+        self.files = 0
+        # (seconds, hexsha, files) of the slowest commits, as a min-heap
+        self.slowest = []
+
+    def write(self, stat):
+        self.commits += 1
+        if stat.files is None:
+            return
+        self.diffed += 1
+        files = len(stat.files[0])
+        self.files += files
+        entry = (stat.seconds, stat.hexsha, files)
+        if len(self.slowest) < SLOWEST:
+            heapq.heappush(self.slowest, entry)
+        elif entry > self.slowest[0]:
+            heapq.heapreplace(self.slowest, entry)
+
+    def close(self):
+        seconds = time.perf_counter() - self.start
+        git_seconds = self.repo.stats.seconds - self.git_start[0]
+        git_bytes = self.repo.stats.bytes - self.git_start[1]
+        report = {
+            "repo": self.repo.path,
+            "engine": self.engine,
+            "jobs": self.jobs,
+            "seconds": seconds,
+            "commits": self.commits,
+            "diffed_commits": self.diffed,
+            "files": self.files,
+            "commits_per_second": self.commits / seconds if seconds else None,
+            "git_bytes": git_bytes,
+            "git_bytes_per_second": git_bytes / seconds if seconds else None,
+            "git_seconds": git_seconds,
+            "python_seconds": max(seconds - git_seconds, 0.0) if self.jobs == 1 else None,
+            "slowest_commits": [
+                {"commit_hash": hexsha, "seconds": commit_seconds, "num_files": files}
+                for commit_seconds, hexsha, files in sorted(self.slowest, reverse=True)
+            ],
+        }
+        with open(self.path, "w") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+
 @click.command()
 @click.argument("repo")
-@click.argument("output") 
-@click.option("-w","--ignore-all-space", is_flag=True, help="Ignore whitespace when comparing the parent commit and the current commit")   
-def main(repo, output, ignore_all_space):
-    # Open the output CSV file for writing
-    with open(output, "w") as f:
-        repo = git.Repo(repo)
-        writer = csv.writer(f)
+@click.argument("output")
+@click.option("-w","--ignore-all-space", is_flag=True, help="Ignore whitespace when comparing the parent commit and the current commit")
+@click.option("--variant", "variants", type=(click.Choice(list(VARIANTS)), str), multiple=True, metavar="VARIANT OUTPUT", help="Also write the numstat of a diff variant (" + ", ".join(VARIANTS) + ") to another CSV, from the same pass")
+@click.option("--engine", type=click.Choice(list(ENGINES)), help="How to compute the numstat: 'diff' runs one git diff per commit, 'log' streams the whole history from a single git log, 'diff-tree' feeds the commits to a single git diff-tree [default: diff, or diff-tree with --commits, --mapping, --all, --cache or --rename-timings]")
+@click.option("-j", "--jobs", type=int, default=1, show_default=True, help="Number of processes computing the numstat of chunks of commits in parallel")
+@click.option("--incremental", is_flag=True, help="Only diff the commits that OUTPUT (or its checkpoint) does not cover yet, and append their rows; also resumes a crashed run")
+@click.option("--include", multiple=True, metavar="PATHSPEC", help="Only diff the paths matching this git pathspec, e.g. '*.java' (can be repeated)")
+@click.option("--exclude", multiple=True, metavar="PATHSPEC", help="Do not diff the paths matching this git pathspec (can be repeated)")
+@click.option("--sizes", is_flag=True, help="Add the blob ids and sizes before and after the change of every file")
+@click.option("--typed", is_flag=True, help="Flag binary files in a binary column (0 or 1) and count their lines as 0, instead of writing '-' counts; load the CSV with columnar.load_frame")
+@click.option("--merges", type=click.Choice(list(MERGE_MODES)), default="skip", show_default=True, help="How to diff merge commits: skip them, diff them against their first parent, or keep the files that differ from every parent (combined)")
+@click.option("--commits", "commit_list", type=click.Path(exists=True, dir_okay=False), help="Only diff the commits listed in this file, one per line, instead of the whole history")
+@click.option("--mapping", type=click.Path(exists=True, dir_okay=False), help="Only diff the commits in a column of this mapping CSV, e.g. the mapping_*.csv written by regit")
+@click.option("--column", default="to", show_default=True, help="The column of --mapping holding the commits of REPO")
+@click.option("--all", "all_refs", is_flag=True, help="Diff the commits of every branch, tag and other ref instead of HEAD, each once, in topological order")
+@click.option("--refs", "refs_path", type=click.Path(dir_okay=False), help="With --all, write the refs containing every commit to this CSV (space-separated)")
+@click.option("--cache", type=click.Path(dir_okay=False), help="SQLite database keeping the numstat of every (old blob, new blob) pair seen, so only unseen pairs are diffed by git (implies --engine diff-tree)")
+@click.option("--cache-limit", type=int, default=DEFAULT_LIMIT, show_default=True, help="Number of blob pairs kept in --cache before the oldest are dropped")
+@click.option("--find-renames", type=click.IntRange(0, 100), metavar="PERCENT", help="Count a deleted and an added file as a rename when they are at least this similar [default: git's, 50]")
+@click.option("--find-copies", type=click.IntRange(0, 100), metavar="PERCENT", help="Also count an added file as a copy of a file changed in the same commit when they are at least this similar")
+@click.option("--no-renames", is_flag=True, help="Count every rename as a deleted and an added file")
+@click.option("--rename-limit", type=click.IntRange(0), metavar="N", help="Skip the inexact rename and copy detection of diffs with more than N candidate files, as it is quadratic in them (git's -l)")
+@click.option("--paths", is_flag=True, help="Add the path of every file before and after the change, which differ for renames and copies")
+@click.option("--rename-timings", type=click.Path(dir_okay=False), help="Write the seconds git spent detecting renames in every commit to this CSV (implies --engine diff-tree)")
+@click.option("--stats", "stats_path", type=click.Path(dir_okay=False), help="Write the throughput of the run to this JSON file: commits and bytes of git output per second, seconds spent in git and in Python, and the slowest commits")
+def main(repo, output, ignore_all_space, variants, engine, jobs, incremental, include, exclude, sizes, typed, merges, commit_list, mapping, column, all_refs, refs_path, cache, cache_limit, find_renames, find_copies, no_renames, rename_limit, paths, rename_timings, stats_path):
+    repo = Repo(repo)
 
-        # Write the header row
-        writer.writerow(["commit_hash", "num_additions", "num_deletions", "filename"])
-
-        # Loop through the commits and get the diff stats
-        for commit in tqdm(list(repo.iter_commits())):
-            if len(parrent := commit.parents) != 1:
-                continue
-            
-            # Option to ignore-all-space
-            diff = repo.git.diff(parrent, commit, numstat=True, ignore_all_space=ignore_all_space)
-            for line in diff.splitlines():
-                num_additions, num_deletions, filename = line.split("\t")
-                writer.writerow([commit.hexsha, num_additions, num_deletions, filename])
+    # An explicit list of commits, if any
+    selected = None
+    if all_refs and (commit_list is not None or mapping is not None):
+        raise click.UsageError("--all cannot be combined with --commits or --mapping")
+    if refs_path is not None and not all_refs:
+        raise click.UsageError("--refs only works with --all")
+    if commit_list is not None or mapping is not None:
+        selected = read_commits(commit_list, mapping, column)
+    elif all_refs:
+        selected = list_all(repo, refs_path)
+    if engine is None:
+        engine = "diff" if selected is None and cache is None and rename_timings is None else "diff-tree"
+    if cache is not None and engine != "diff-tree":
+        raise click.UsageError("--cache only works with --engine diff-tree")
+    if rename_timings is not None and engine != "diff-tree":
+        raise click.UsageError("--rename-timings only works with --engine diff-tree")
+    if no_renames and (find_renames is not None or find_copies is not None):
+        raise click.UsageError("--no-renames cannot be combined with --find-renames or --find-copies")
+
+    variants = [("ignore-all-space" if ignore_all_space else "plain", output)] + list(variants)
+
+    with contextlib.ExitStack() as stack:
+        # Written last, once everything else is closed
+        run_stats = None
+        if stats_path is not None:
+            run_stats = RunStats(stats_path, repo, engine, jobs)
+            stack.callback(run_stats.close)
+
+        # Open the outputs (CSV, or columns) for writing
+        outputs = []
+        for _, path in variants:
+            outputs.append(out := open_output(path, incremental, sizes, paths, typed))
+            stack.callback(out.close)
+
+        timings = None
+        if rename_timings is not None:
+            timings = RenameTimings(rename_timings)
+            stack.callback(timings.close)
+
+        # Sizes are looked up in bulk from one cat-file process
+        batch = None
+        if sizes:
+            batch = BatchCheck(repo)
+            stack.callback(batch.close)
+
+        # Only diff the commits that some output does not cover yet
+        done = set.intersection(*(out.done for out in outputs))
+        commits = None
+        if selected is not None:
+            commits = [hexsha for hexsha in selected if hexsha not in done]
+            total = len(commits)
+        else:
+            if done:
+                commits = (hexsha for hexsha in iter_hexshas(repo) if hexsha not in done)
+            total = max(count_commits(repo) - len(done), 0)
+
+        # Loop through the commits as they are streamed and get the diff stats
+        renames = make_rename_flags(find_renames, find_copies, no_renames, rename_limit)
+        options = dict(commits=commits, variants=[VARIANTS[name] for name, _ in variants], pathspecs=make_pathspecs(include, exclude), blobs=sizes or paths, merges=merges, renames=renames)
+        if cache is not None:
+            options.update(cache=cache, cache_limit=cache_limit)
+        if timings is not None:
+            options.update(rename_timings=True)
+        if jobs > 1:
+            stats = parallel_engine(repo, engine, jobs, **options)
+        else:
+            stats = ENGINES[engine](repo, **options)
+            if run_stats is not None:
+                stats = timed(stats)
+        for stat in tqdm(stats, total=total):
+            if batch is not None:
+                stat = batch.add_sizes(stat)
+            for i, out in enumerate(outputs):
+                out.write(stat, None if stat.files is None else stat.files[i])
+            if timings is not None:
+                timings.write(stat)
+            if run_stats is not None:
+                run_stats.write(stat)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,184 @@
+import click
+import collections
+import contextlib
+import csv
+import functools
+import logging
+from tqdm import tqdm
+from tree_sitter import Parser
+
+from formast.__main__ import FORMATS, JAVA_LANGUAGE, format_source, is_java_file, source_tokens
+from formast.treediff import FlatTree, tree_diff
+
+import linediff
+from catfile import CatFile
+from commitdiff import open_output
+from numstat import GITLINK_MODE, MERGE_MODES, RAW_FLAGS, VARIANTS, DiffTree, count_commits, diff_commits, entry_stat, is_droppable, iter_parents, make_pathspecs, numstat_filename
+from plumbing import Repo
+
+log = logging.getLogger(__name__)
+
+## Per-format numstat from the original history
+#
+# Instead of rewriting the history once per format and running commitdiff
+# on every copy, the original history is walked once. The Java blobs on
+# both sides of every change are formatted in memory, and the formatted
+# versions are diffed without git (see linediff), giving for every format
+# the rows commitdiff would give on the rewritten history, under the
+# original commit ids. Other files are diffed as they are, as a rewrite
+# leaves them alone. Renames are the ones git finds in the original history.
+# The token format is not even written out: its lines are taken straight
+# from the leaves of the tree.
+
+# The original files, unformatted
+PLAIN = "java"
+
+# The structural diff of a Java file, see formast.treediff
+TreeStat = collections.namedtuple("TreeStat", ["subtrees_inserted", "subtrees_deleted", "subtrees_moved", "filename"])
+
+# Blobs whose formatted versions are kept around; most blobs are needed
+# again by the next commit touching the file
+BLOB_CACHE = 1024
+
+class BlobFormatter:
+    """Reads blobs and formats them into lines, keeping the most recently used ones."""
+    def __init__(self, cat_file, use_bytes=False, limit=BLOB_CACHE):
+        self.cat_file = cat_file
+        self.parser = Parser()
+        self.parser.set_language(JAVA_LANGUAGE)
+        self.use_bytes = use_bytes
+        self.limit = limit
+        self.cache = collections.OrderedDict()
+
+    def lines(self, oid, path, fmt, mode=None):
+        """Return the lines of the blob OID, found at PATH with MODE, in format FMT (none for no blob)."""
+        if oid is None:
+            return []
+        # A submodule is a commit of another repository, which git diffs as one line
+        if mode == GITLINK_MODE:
+            return [b"Subproject commit " + oid.encode("ascii") + b"\n"]
+        # Only Java files get formatted; paths git had to quote keep their quotes
+        if not is_java_file(path.strip('"')):
+            fmt = PLAIN
+
+        def make():
+            source = self.source(oid)
+            if fmt == PLAIN:
+                return linediff.split_lines(source)
+            try:
+                # The token format is one leaf per line, which needs no output
+                if fmt == "token":
+                    return linediff.token_lines(source_tokens(self.parser, source))
+                return linediff.split_lines(format_source(self.parser, source, fmt, self.use_bytes))
+            except (ValueError, UnicodeDecodeError) as e:
+                log.warning("Cannot format %s (%s) as %s, diffing it as it is: %s", path, oid, fmt, e)
+                return linediff.split_lines(source)
+        return self.cached((oid, fmt), make)
+
+    def source(self, oid):
+        return self.cached((oid, None), lambda: self.cat_file.read(oid))
+
+    def tree(self, oid):
+        """Return the FlatTree of the Java blob OID (of an empty file for None)."""
+        def make():
+            source = b"" if oid is None else self.source(oid)
+            return FlatTree(self.parser.parse(source), source)
+        return self.cached((oid, "tree"), make)
+
+    def cached(self, key, make):
+        value = self.cache.get(key)
+        if value is not None:
+            self.cache.move_to_end(key)
+            return value
+        value = self.cache[key] = make()
+        if len(self.cache) > self.limit:
+            self.cache.popitem(last=False)
+        return value
+
+def format_diff(entries, blobs, fmt, flags=()):
+    """Make the diff function of format FMT, for diff_commits."""
+    def diff(parent, hexsha):
+        files = []
+        for entry in entries(parent, hexsha):
+            old = blobs.lines(entry.old_blob, entry.paths[0], fmt, entry.old_mode)
+            new = blobs.lines(entry.new_blob, entry.paths[-1], fmt, entry.new_mode)
+            counts = linediff.numstat_lines(old, new, flags)
+            # A change the format does not show leaves the rewritten file as it was
+            if is_droppable(entry) and (old == new or counts == (0, 0)):
+                continue
+            num_additions, num_deletions = ("-", "-") if counts is None else map(str, counts)
+            files.append(entry_stat(entry, num_additions, num_deletions))
+        return files
+    return diff
+
+def tree_diffs(entries, blobs):
+    """Make the diff function giving a TreeStat for every Java file, for diff_commits."""
+    def diff(parent, hexsha):
+        files = []
+        for entry in entries(parent, hexsha):
+            if not is_java_file(entry.paths[-1].strip('"')) or GITLINK_MODE in (entry.old_mode, entry.new_mode):
+                continue
+            inserted, deleted, moved = tree_diff(blobs.tree(entry.old_blob), blobs.tree(entry.new_blob))
+            files.append(TreeStat(inserted, deleted, moved, numstat_filename(entry)))
+        return files
+    return diff
+
+class TreeOutput:
+    """A CSV with the TreeStat of every Java file of every commit."""
+    def __init__(self, path):
+        self.file = open(path, "w")
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(["commit_hash", *TreeStat._fields])
+
+    def write(self, stat, files):
+        if files is not None:
+            self.writer.writerows([stat.hexsha, *f] for f in files)
+
+    def close(self):
+        self.file.close()
+
+@click.command()
+@click.argument("repo")
+@click.option("--format", "formats", type=(click.Choice([PLAIN, *FORMATS]), str), multiple=True, metavar="FORMAT OUTPUT", help="Write the numstat of the history formatted as FORMAT (" + ", ".join([PLAIN, *FORMATS]) + ") to OUTPUT, a CSV or columnar file like commitdiff writes (can be repeated)")
+@click.option("--tree", "tree_output", type=str, metavar="OUTPUT", help="Also write how many subtrees of every Java file were inserted, deleted or moved to this CSV")
+@click.option("-w", "--ignore-all-space", is_flag=True, help="Ignore whitespace when comparing the parent commit and the current commit")
+@click.option("--include", multiple=True, metavar="PATHSPEC", help="Only diff the paths matching this git pathspec, e.g. '*.java' (can be repeated)")
+@click.option("--exclude", multiple=True, metavar="PATHSPEC", help="Do not diff the paths matching this git pathspec (can be repeated)")
+@click.option("--merges", type=click.Choice(list(MERGE_MODES)), default="skip", show_default=True, help="How to diff merge commits, as for commitdiff")
+@click.option("--typed", is_flag=True, help="Flag binary files in a binary column instead of writing '-' counts, as for commitdiff")
+@click.option("--bytes", "use_bytes", is_flag=True, help="Format with the bytes emitters, as formast --bytes does")
+@click.option("--blob-cache", type=int, default=BLOB_CACHE, show_default=True, help="Number of formatted blobs kept in memory")
+def main(repo, formats, tree_output, ignore_all_space, include, exclude, merges, typed, use_bytes, blob_cache):
+    if not formats and tree_output is None:
+        raise click.UsageError("Nothing to write, give --format or --tree.")
+    if tree_output is not None and merges == "combined":
+        raise click.UsageError("--tree cannot combine the diffs of merge commits.")
+    repo = Repo(repo)
+    flags = VARIANTS["ignore-all-space" if ignore_all_space else "plain"]
+
+    with contextlib.ExitStack() as stack:
+        outputs = []
+        for _, path in formats:
+            outputs.append(out := open_output(path, typed=typed))
+            stack.callback(out.close)
+
+        cat_file = CatFile(repo)
+        stack.callback(cat_file.close)
+        listing = DiffTree(repo, RAW_FLAGS, make_pathspecs(include, exclude))
+        stack.callback(listing.close)
+
+        # Every format diffs the same files of a commit
+        entries = functools.lru_cache(maxsize=8)(listing.entries)
+        blobs = BlobFormatter(cat_file, use_bytes, blob_cache)
+        diffs = [format_diff(entries, blobs, fmt, flags) for fmt, _ in formats]
+        if tree_output is not None:
+            outputs.append(out := TreeOutput(tree_output))
+            stack.callback(out.close)
+            diffs.append(tree_diffs(entries, blobs))
+
+        for stat in tqdm(diff_commits(iter_parents(repo), diffs, merges), total=count_commits(repo)):
+            for i, out in enumerate(outputs):
+                out.write(stat, None if stat.files is None else stat.files[i])
+
+if __name__ == "__main__":
+    main()
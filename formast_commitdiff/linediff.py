@@ -0,0 +1,345 @@
+import collections
+import sys
+
+## Line diff counts without git
+#
+# Counts the lines added and deleted between two blobs like
+# `git diff --numstat`, from bytes already in memory. Every distinct line is
+# interned to an int first, so the diff itself only compares ints. The diff
+# follows git's own Myers implementation (xdiff), heuristics included, since
+# those decide the counts whenever a minimal diff is too expensive: the
+# common prefix and suffix are skipped, lines without a match on the other
+# side are set aside, and so are lines with many matches that sit among
+# them, before the middle snakes are searched in linear space.
+
+# git calls a blob binary when one of its first bytes is NUL
+BINARY_CHECK_BYTES = 8000
+
+# Lines looked at around a line with many matches, when deciding to set it aside
+SIMSCAN_WINDOW = 100
+
+# A line with many matches is set aside when fewer than 1 in KPDIS_RUN of the
+# lines around it have many matches too (the rest having none)
+KPDIS_RUN = 4
+
+# Upper bound on the matches that make a line have "many"
+MAX_EQLIMIT = 1024
+
+# Edit costs from which the search settles for a good enough split
+MAX_COST_MIN = 256
+HEUR_MIN_COST = 256
+
+# Length of a snake that makes a path interesting, and how interesting
+SNAKE_CNT = 20
+K_HEUR = 4
+
+# Beyond the end of any box
+LINE_MAX = sys.maxsize
+
+def is_binary(data):
+    return b"\0" in data[:BINARY_CHECK_BYTES]
+
+def split_lines(data):
+    # Lines keep their newline, so a last line without one differs from the
+    # same line with one, as it does for git
+    lines = data.split(b"\n")
+    last = lines.pop()
+    lines = [line + b"\n" for line in lines]
+    if last:
+        lines.append(last)
+    return lines
+
+def token_lines(tokens):
+    # The lines of a file holding one token per line; a token spanning lines,
+    # such as a block comment, is several of them
+    return [part + b"\n" for token in tokens for part in token.split(b"\n")]
+
+def is_binary_lines(lines):
+    # is_binary on the file the lines make up
+    position = 0
+    for line in lines:
+        if position >= BINARY_CHECK_BYTES:
+            break
+        if b"\0" in line[:BINARY_CHECK_BYTES - position]:
+            return True
+        position += len(line)
+    return False
+
+def ignore_all_space(line):
+    return b"".join(line.split())
+
+def ignore_space_change(line):
+    # Runs of whitespace count as one space, and whitespace at the end of a
+    # line does not count at all
+    stripped = line.rstrip()
+    return (b" " if stripped[:1].isspace() else b"") + b" ".join(stripped.split())
+
+def intern_lines(old_lines, new_lines, key=None):
+    """Replace every line by an int, the same int for lines equal after KEY."""
+    ids = {}
+    def intern(lines):
+        return [ids.setdefault(line if key is None else key(line), len(ids)) for line in lines]
+    return intern(old_lines), intern(new_lines)
+
+def bogosqrt(n):
+    # The rough square root xdiff uses
+    i = 1
+    while n > 0:
+        n >>= 2
+        i <<= 1
+    return i
+
+def clean_mmatch(dis, i, s, e):
+    """Whether the line I with many matches sits among lines without any, in DIS[S..E]."""
+    s = max(s, i - SIMSCAN_WINDOW)
+    e = min(e, i + SIMSCAN_WINDOW)
+
+    nomatch_before, many_before = 0, 1
+    r = 1
+    while i - r >= s:
+        if dis[i - r] == 0:
+            nomatch_before += 1
+        elif dis[i - r] == 2:
+            many_before += 1
+        else:
+            break
+        r += 1
+    if nomatch_before == 0:
+        return False
+
+    nomatch_after, many_after = 0, 1
+    r = 1
+    while i + r <= e:
+        if dis[i + r] == 0:
+            nomatch_after += 1
+        elif dis[i + r] == 2:
+            many_after += 1
+        else:
+            break
+        r += 1
+    if nomatch_after == 0:
+        return False
+
+    many = many_before + many_after
+    return many * KPDIS_RUN < many + nomatch_before + nomatch_after
+
+def cleanup(lines, counts_other, start, end):
+    """Split the lines in LINES[START..END] into those to diff and the number set aside."""
+    limit = min(bogosqrt(len(lines)), MAX_EQLIMIT)
+    dis = {}
+    for i in range(start, end + 1):
+        matches = counts_other.get(lines[i], 0)
+        dis[i] = 0 if matches == 0 else 2 if matches >= limit else 1
+    kept = [lines[i] for i in range(start, end + 1) if dis[i] == 1 or (dis[i] == 2 and not clean_mmatch(dis, i, start, end))]
+    return kept, end - start + 1 - len(kept)
+
+def split(a, off1, lim1, b, off2, lim2, kvdf, kvdb, need_min, mxcost):
+    """Find where to split the boxes A[OFF1:LIM1] and B[OFF2:LIM2], like xdl_split.
+
+    KVDF and KVDB are the forward and backward furthest reaching paths,
+    dicts by diagonal. Returns (i1, i2, min_lo, min_hi), where min_lo and
+    min_hi tell whether the halves still need a minimal diff.
+    """
+    dmin, dmax = off1 - lim2, lim1 - off2
+    fmid, bmid = off1 - off2, lim1 - lim2
+    odd = (fmid - bmid) & 1
+    fmin = fmax = fmid
+    bmin = bmax = bmid
+    kvdf[fmid] = off1
+    kvdb[bmid] = lim1
+
+    ec = 0
+    while True:
+        ec += 1
+        got_snake = False
+
+        # Extend the diagonals of the forward search by one, within the box
+        if fmin > dmin:
+            fmin -= 1
+            kvdf[fmin - 1] = -1
+        else:
+            fmin += 1
+        if fmax < dmax:
+            fmax += 1
+            kvdf[fmax + 1] = -1
+        else:
+            fmax -= 1
+
+        for d in range(fmax, fmin - 1, -2):
+            if kvdf[d - 1] >= kvdf[d + 1]:
+                i1 = kvdf[d - 1] + 1
+            else:
+                i1 = kvdf[d + 1]
+            prev1 = i1
+            i2 = i1 - d
+            while i1 < lim1 and i2 < lim2 and a[i1] == b[i2]:
+                i1 += 1
+                i2 += 1
+            if i1 - prev1 > SNAKE_CNT:
+                got_snake = True
+            kvdf[d] = i1
+            if odd and bmin <= d <= bmax and kvdb[d] <= i1:
+                return i1, i2, True, True
+
+        # Same for the backward search
+        if bmin > dmin:
+            bmin -= 1
+            kvdb[bmin - 1] = LINE_MAX
+        else:
+            bmin += 1
+        if bmax < dmax:
+            bmax += 1
+            kvdb[bmax + 1] = LINE_MAX
+        else:
+            bmax -= 1
+
+        for d in range(bmax, bmin - 1, -2):
+            if kvdb[d - 1] < kvdb[d + 1]:
+                i1 = kvdb[d - 1]
+            else:
+                i1 = kvdb[d + 1] - 1
+            prev1 = i1
+            i2 = i1 - d
+            while i1 > off1 and i2 > off2 and a[i1 - 1] == b[i2 - 1]:
+                i1 -= 1
+                i2 -= 1
+            if prev1 - i1 > SNAKE_CNT:
+                got_snake = True
+            kvdb[d] = i1
+            if not odd and fmin <= d <= fmax and i1 <= kvdf[d]:
+                return i1, i2, True, True
+
+        if need_min:
+            continue
+
+        # Past the heuristic trigger, settle for a path that got far enough
+        # along a long snake
+        if got_snake and ec > HEUR_MIN_COST:
+            best = 0
+            for d in range(fmax, fmin - 1, -2):
+                i1 = kvdf[d]
+                i2 = i1 - d
+                v = (i1 - off1) + (i2 - off2) - abs(d - fmid)
+                if v > K_HEUR * ec and v > best and off1 + SNAKE_CNT <= i1 < lim1 and off2 + SNAKE_CNT <= i2 < lim2:
+                    if all(a[i1 - k] == b[i2 - k] for k in range(1, SNAKE_CNT + 1)):
+                        best = v
+                        found = i1, i2
+            if best > 0:
+                return found[0], found[1], True, False
+
+            best = 0
+            for d in range(bmax, bmin - 1, -2):
+                i1 = kvdb[d]
+                i2 = i1 - d
+                v = (lim1 - i1) + (lim2 - i2) - abs(d - bmid)
+                if v > K_HEUR * ec and v > best and off1 < i1 <= lim1 - SNAKE_CNT and off2 < i2 <= lim2 - SNAKE_CNT:
+                    if all(a[i1 + k] == b[i2 + k] for k in range(SNAKE_CNT)):
+                        best = v
+                        found = i1, i2
+            if best > 0:
+                return found[0], found[1], False, True
+
+        # Too expensive: take the furthest reaching path of either search
+        if ec >= mxcost:
+            fbest = fbest1 = -1
+            for d in range(fmax, fmin - 1, -2):
+                i1 = min(kvdf[d], lim1)
+                i2 = i1 - d
+                if lim2 < i2:
+                    i1 = lim2 + d
+                    i2 = lim2
+                if fbest < i1 + i2:
+                    fbest = i1 + i2
+                    fbest1 = i1
+
+            bbest = bbest1 = LINE_MAX
+            for d in range(bmax, bmin - 1, -2):
+                i1 = max(off1, kvdb[d])
+                i2 = i1 - d
+                if i2 < off2:
+                    i1 = off2 + d
+                    i2 = off2
+                if i1 + i2 < bbest:
+                    bbest = i1 + i2
+                    bbest1 = i1
+
+            if (lim1 + lim2) - bbest < fbest - (off1 + off2):
+                return fbest1, fbest - fbest1, True, False
+            return bbest1, bbest - bbest1, False, True
+
+def changed_lines(a, b, need_min=False):
+    """Return how many lines of A and of B the diff of A into B changes."""
+    mxcost = max(bogosqrt(len(a) + len(b) + 3), MAX_COST_MIN)
+    kvdf, kvdb = {}, {}
+    changed_a = changed_b = 0
+
+    # The boxes left to diff, split in two until one side is empty
+    boxes = [(0, len(a), 0, len(b), need_min)]
+    while boxes:
+        off1, lim1, off2, lim2, need_min = boxes.pop()
+        while off1 < lim1 and off2 < lim2 and a[off1] == b[off2]:
+            off1 += 1
+            off2 += 1
+        while off1 < lim1 and off2 < lim2 and a[lim1 - 1] == b[lim2 - 1]:
+            lim1 -= 1
+            lim2 -= 1
+
+        if off1 == lim1 or off2 == lim2:
+            changed_a += lim1 - off1
+            changed_b += lim2 - off2
+            continue
+        i1, i2, min_lo, min_hi = split(a, off1, lim1, b, off2, lim2, kvdf, kvdb, need_min, mxcost)
+        boxes.append((off1, i1, off2, i2, min_lo))
+        boxes.append((i1, lim1, i2, lim2, min_hi))
+    return changed_a, changed_b
+
+def diff_counts(a, b):
+    """Return (additions, deletions) turning the sequence of ints A into B."""
+    # Skip the common prefix and suffix
+    prefix = 0
+    limit = min(len(a), len(b))
+    while prefix < limit and a[prefix] == b[prefix]:
+        prefix += 1
+    suffix = 0
+    while suffix < limit - prefix and a[-1 - suffix] == b[-1 - suffix]:
+        suffix += 1
+
+    # Lines are matched against all of the other side, prefix and suffix included
+    counts_a = collections.Counter(a)
+    counts_b = collections.Counter(b)
+    kept_a, set_aside_a = cleanup(a, counts_b, prefix, len(a) - suffix - 1)
+    kept_b, set_aside_b = cleanup(b, counts_a, prefix, len(b) - suffix - 1)
+
+    changed_a, changed_b = changed_lines(kept_a, kept_b)
+    return changed_b + set_aside_b, changed_a + set_aside_a
+
+def numstat(old, new, flags=()):
+    """Return (additions, deletions) between the blobs OLD and NEW, None if either is binary.
+
+    FLAGS can hold the whitespace options "--ignore-all-space" and
+    "--ignore-space-change", as in VARIANTS. A missing blob is None.
+    """
+    check_flags(flags)
+    old = old or b""
+    new = new or b""
+    if is_binary(old) or is_binary(new):
+        return None
+    return numstat_lines(split_lines(old), split_lines(new), flags)
+
+def numstat_lines(old, new, flags=()):
+    """Like numstat, for blobs already split into lines (see split_lines and token_lines)."""
+    check_flags(flags)
+    if is_binary_lines(old) or is_binary_lines(new):
+        return None
+
+    key = None
+    if "--ignore-all-space" in flags:
+        key = ignore_all_space
+    elif "--ignore-space-change" in flags:
+        key = ignore_space_change
+    return diff_counts(*intern_lines(old, new, key))
+
+def check_flags(flags):
+    unknown = set(flags) - {"--ignore-all-space", "--ignore-space-change"}
+    if unknown:
+        raise ValueError("Cannot diff with {}".format(" ".join(sorted(unknown))))
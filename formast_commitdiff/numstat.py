@@ -0,0 +1,564 @@
+import collections
+import contextlib
+import functools
+import itertools
+import json
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from paircache import DEFAULT_LIMIT, PairCache
+from plumbing import GitError, Repo
+
+## Numstat engines
+#
+# An engine walks the history of a repository, or the given list of commits,
+# and yields a CommitStat for every commit it visits, in `git rev-list` order
+# (or in the order given). Every engine diffs a commit once for each of the
+# given variants (sets of extra `git diff` flags, see VARIANTS), sharing the
+# commit enumeration between them, and only reports the paths matched by the
+# given git pathspecs. Rename and copy detection is git's default unless other
+# rename flags are given (see make_rename_flags). Commits that are not diffed
+# have `files` set to None: root commits, and merge commits unless a merge
+# mode other than "skip" is given (see MERGE_MODES).
+
+# One changed file of a commit, as reported by `git diff --numstat`. The blob
+# ids, paths and modes are only filled in when asked for (None where the file
+# does not exist), and the sizes are added afterwards, see BatchCheck.
+FileStat = collections.namedtuple(
+    "FileStat",
+    ["num_additions", "num_deletions", "filename", "old_blob", "new_blob", "old_size", "new_size", "old_path", "new_path", "old_mode", "new_mode"],
+    defaults=(None, None, None, None, None, None, None, None),
+)
+
+# The numstat of one commit against its parent, one list of files per
+# variant, the seconds git spent detecting renames when asked for, and the
+# seconds it took to compute, see timed
+CommitStat = collections.namedtuple("CommitStat", ["hexsha", "parents", "files", "rename_time", "seconds"], defaults=(None, None))
+
+# Variants of the diff, by name
+VARIANTS = {
+    "plain": (),
+    "ignore-all-space": ("--ignore-all-space",),
+    "ignore-space-change": ("--ignore-space-change",),
+    "ignore-blank-lines": ("--ignore-blank-lines",),
+}
+
+# Marks the start of every commit in the streamed log
+LOG_FORMAT = "--format=%x00%H %P"
+
+# Full blob ids, from --raw lines in front of the numstat
+RAW_FLAGS = ("--raw", "--no-abbrev")
+
+NULL_OID = "0" * 40
+
+# The mode of a submodule, whose "blob" is a commit of another repository
+GITLINK_MODE = "160000"
+
+def make_pathspecs(include=(), exclude=()):
+    return list(include) + [":(exclude)" + pattern for pattern in exclude]
+
+def make_rename_flags(find_renames=None, find_copies=None, no_renames=False, rename_limit=None):
+    """The git diff flags for rename and copy detection; none keeps git's defaults."""
+    flags = []
+    if no_renames:
+        flags.append("--no-renames")
+    if find_renames is not None:
+        flags.append("--find-renames={}%".format(find_renames))
+    if find_copies is not None:
+        flags.append("--find-copies={}%".format(find_copies))
+    if rename_limit is not None:
+        flags.append("-l{}".format(rename_limit))
+    return tuple(flags)
+
+def count_commits(repo):
+    # Cheap total for the progress bar, without loading any commit objects
+    return int(repo.run("rev-list", "--count", "HEAD"))
+
+def parse_numstat(line):
+    num_additions, num_deletions, filename = line.split("\t")
+    return FileStat(num_additions, num_deletions, filename)
+
+# One file of a `--raw` diff: ":<old mode> <new mode> <old blob> <new blob> <status>\t<path>..."
+RawEntry = collections.namedtuple("RawEntry", ["old_mode", "new_mode", "old_blob", "new_blob", "status", "paths"])
+
+def parse_raw(line):
+    info, *paths = line.split("\t")
+    old_mode, new_mode, old_blob, new_blob, status = info[1:].split(" ")
+    return RawEntry(
+        old_mode, new_mode,
+        None if old_blob == NULL_OID else old_blob,
+        None if new_blob == NULL_OID else new_blob,
+        status, paths,
+    )
+
+def entry_paths(entry):
+    # (old path, new path), None where the file does not exist
+    if entry.status == "A":
+        return None, entry.paths[0]
+    if entry.status == "D":
+        return entry.paths[0], None
+    return entry.paths[0], entry.paths[-1]
+
+def entry_mode(mode):
+    # "000000" where the file does not exist
+    return None if mode == "000000" else mode
+
+def entry_stat(entry, num_additions, num_deletions):
+    """The FileStat of a --raw ENTRY with the given counts."""
+    old_path, new_path = entry_paths(entry)
+    return FileStat(num_additions, num_deletions, numstat_filename(entry), entry.old_blob, entry.new_blob, old_path=old_path, new_path=new_path, old_mode=entry_mode(entry.old_mode), new_mode=entry_mode(entry.new_mode))
+
+def is_droppable(entry):
+    # With whitespace flags, a change of the contents alone that turns out
+    # empty is left out of the numstat, but not out of the --raw listing
+    return entry.status == "M" and entry.old_mode == entry.new_mode
+
+def parse_files(lines):
+    """Parse the numstat lines of one diff, with the --raw lines if any."""
+    raw = [parse_raw(line) for line in lines if line.startswith(":")]
+    files = [parse_numstat(line) for line in lines if line and not line.startswith(":")]
+    if not raw:
+        return files
+
+    # Both list the files of the diff in the same order
+    paired = []
+    stats = iter(files)
+    f = next(stats, None)
+    for entry in raw:
+        if is_droppable(entry) and (f is None or f.filename != entry.paths[0]):
+            continue
+        if f is None:
+            raise RuntimeError("The --raw and --numstat output of a diff do not match")
+        old_path, new_path = entry_paths(entry)
+        paired.append(f._replace(
+            old_blob=entry.old_blob, new_blob=entry.new_blob,
+            old_path=old_path, new_path=new_path,
+            old_mode=entry_mode(entry.old_mode), new_mode=entry_mode(entry.new_mode),
+        ))
+        f = next(stats, None)
+    if f is not None:
+        raise RuntimeError("The --raw and --numstat output of a diff do not match")
+    return paired
+
+def numstat_filename(entry):
+    """The filename `git diff --numstat` shows for a --raw ENTRY.
+
+    Renames and copies are shown like "dir/{old => new}.java", the way git
+    abbreviates them; paths git had to quote are shown in full.
+    """
+    if len(entry.paths) == 1:
+        return entry.paths[0]
+    a, b = entry.paths
+    if a.startswith('"') or b.startswith('"'):
+        return "{} => {}".format(a, b)
+
+    # The common prefix and suffix, up to a slash
+    prefix = 0
+    for i, (x, y) in enumerate(zip(a, b)):
+        if x != y:
+            break
+        if x == "/":
+            prefix = i + 1
+    suffix = 0
+    i, j = len(a) - 1, len(b) - 1
+    stop = prefix - 1 if prefix else 0
+    while i >= stop and j >= stop and a[i] == b[j]:
+        if a[i] == "/":
+            suffix = len(a) - i
+        i -= 1
+        j -= 1
+
+    a_mid = a[prefix:max(len(a) - suffix, prefix)]
+    b_mid = b[prefix:max(len(b) - suffix, prefix)]
+    if prefix + suffix:
+        return "{}{{{} => {}}}{}".format(a[:prefix], a_mid, b_mid, a[len(a) - suffix:])
+    return "{} => {}".format(a_mid, b_mid)
+
+# How merge commits are diffed
+MERGE_MODES = {
+    "skip": None,
+    # Against the first parent, like a regular commit
+    "first-parent": "--diff-merges=first-parent",
+    # Only the files that differ from every parent, see combine_diffs
+    "combined": "--diff-merges=separate",
+}
+
+def combine_diffs(diffs):
+    """Combine the diffs of a merge against each of its parents.
+
+    Like a combined diff, only the files that differ from every parent are
+    kept, each counted against the parent it is closest to.
+    """
+    if not diffs or not all(diffs):
+        return []
+
+    others = [{f.filename: f for f in diff} for diff in diffs[1:]]
+    files = []
+    for f in diffs[0]:
+        candidates = [f] + [other.get(f.filename) for other in others]
+        if None in candidates:
+            continue
+        files.append(min(candidates, key=num_changes))
+    return files
+
+def typed_counts(f):
+    """Return (additions, deletions, binary) of F as ints and a bool; binary files count 0."""
+    if f.num_additions == "-":
+        return 0, 0, True
+    return int(f.num_additions), int(f.num_deletions), False
+
+def num_changes(f):
+    # Binary files are as far away as it gets
+    if f.num_additions == "-":
+        return float("inf")
+    return int(f.num_additions) + int(f.num_deletions)
+
+def iter_parents(repo, commits=None):
+    """Stream (hexsha, parents) for HEAD, or for the given commits.
+
+    The parents of every commit come from a single `git rev-list --parents`
+    process instead of reading a commit object per revision.
+    """
+    if commits is None:
+        proc = repo.popen("rev-list", "--parents", "HEAD")
+    else:
+        proc = repo.popen("rev-list", "--no-walk=unsorted", "--parents", "--stdin", stdin=True)
+        proc.stdin.write("".join(hexsha + "\n" for hexsha in commits).encode("ascii"))
+        proc.stdin.close()
+    for line in proc.stdout:
+        hexsha, *parents = line.decode("ascii").split()
+        yield hexsha, parents
+    proc.wait()
+
+def iter_hexshas(repo):
+    # Stream the commit ids of HEAD without building Commit objects
+    proc = repo.popen("rev-list", "HEAD")
+    for line in proc.stdout:
+        yield line.decode("ascii").strip()
+    proc.wait()
+
+## Every ref
+#
+# `git rev-list --all --topo-order` lists every commit reachable from any
+# ref once, children before parents. The refs containing a commit are the
+# refs pointing at it and those containing any of its children, so they are
+# complete by the time the commit is listed, and are passed on to its
+# parents from there. Most commits share the same few sets of refs, which
+# are kept once each.
+
+def ref_tips(repo):
+    """Return the refs pointing at every commit, annotated tags peeled, with HEAD when it is detached."""
+    tips = collections.defaultdict(set)
+    output = repo.run("for-each-ref", "--format=%(objectname)%00%(*objectname)%00%(refname)")
+    for line in output.decode("utf-8", "surrogateescape").splitlines():
+        oid, peeled, refname = line.split("\0")
+        tips[peeled or oid].add(refname)
+    try:
+        repo.run("symbolic-ref", "-q", "HEAD")
+    except GitError:
+        # Detached (or unborn, when there is nothing to list anyway)
+        with contextlib.suppress(GitError):
+            tips[repo.run("rev-parse", "--verify", "-q", "HEAD").decode("ascii").strip()].add("HEAD")
+    return tips
+
+def iter_all(repo):
+    """Stream (hexsha, refs) for every commit of every ref, once each, in topological order.
+
+    `refs` is the frozenset of the names of the refs containing the commit.
+    """
+    empty = frozenset()
+    interned = {empty: empty}
+    unions = {}
+
+    def intern(refs):
+        return interned.setdefault(refs, refs)
+
+    def union(a, b):
+        if a is b or not b:
+            return a
+        if not a:
+            return b
+        key = (id(a), id(b))
+        result = unions.get(key)
+        if result is None:
+            result = unions[key] = intern(a | b)
+        return result
+
+    tips = {hexsha: intern(frozenset(refs)) for hexsha, refs in ref_tips(repo).items()}
+    # The refs gathered so far for the commits whose children were listed
+    pending = {}
+    proc = repo.popen("rev-list", "--all", "--topo-order", "--parents")
+    for line in proc.stdout:
+        hexsha, *parents = line.decode("ascii").split()
+        refs = union(pending.pop(hexsha, empty), tips.get(hexsha, empty))
+        yield hexsha, refs
+        for parent in parents:
+            pending[parent] = union(pending.get(parent, empty), refs)
+    proc.wait()
+
+def diff_engine(repo, commits=None, variants=((),), pathspecs=(), blobs=False, merges="skip", renames=()):
+    """Run one `git diff --numstat` process per commit and variant (and parent, for combined merges)."""
+    raw_flags = RAW_FLAGS if blobs else ()
+
+    def differ(flags):
+        def diff(parent, hexsha):
+            output = repo.run("diff", "--numstat", *renames, *flags, *raw_flags, parent, hexsha, "--", *pathspecs)
+            return parse_files(output.decode("utf-8", "surrogateescape").splitlines())
+        return diff
+
+    yield from diff_commits(iter_parents(repo, commits), [differ(flags) for flags in variants], merges)
+
+def diff_commits(parents_of, diffs, merges="skip"):
+    """Diff every (hexsha, parents) in PARENTS_OF with each of DIFFS, one per variant."""
+    for hexsha, parents in parents_of:
+        if not parents or (len(parents) > 1 and merges == "skip"):
+            yield CommitStat(hexsha, parents, None)
+            continue
+
+        if len(parents) > 1 and merges == "combined":
+            files = tuple(combine_diffs([diff(parent, hexsha) for parent in parents]) for diff in diffs)
+        else:
+            files = tuple(diff(parents[0], hexsha) for diff in diffs)
+        yield CommitStat(hexsha, parents, files)
+
+## Diffs from a long-lived git diff-tree
+#
+# `git diff-tree --stdin` reads "<commit> <parent>" lines and prints the diff
+# of each, and echoes any line that is not a commit id. Writing a sentinel
+# after every request marks where its diff ends, so one process per variant
+# serves a whole run.
+
+# Echoed back by git diff-tree after each diff
+SENTINEL = "#end"
+
+# git diff and git log detect renames by default, git diff-tree has to be asked
+DIFF_TREE_FLAGS = ("-r", "-M", "--no-commit-id")
+
+class DiffTree:
+    """One `git diff-tree --stdin` process, answering one diff at a time.
+
+    With TRACE, git traces its rename detection to a temporary file, and
+    `rename_time` adds up the seconds it took, see take_rename_time.
+    """
+    def __init__(self, repo, flags=(), pathspecs=(), trace=False):
+        env = None
+        self.trace = None
+        if trace:
+            fd, path = tempfile.mkstemp(prefix="diff-tree-", suffix=".trace")
+            self.trace = os.fdopen(fd, "rb")
+            self.trace_path = path
+            env = {"GIT_TRACE2_EVENT": path}
+        self.rename_time = 0.0
+        self.proc = repo.popen("diff-tree", "--stdin", *DIFF_TREE_FLAGS, *flags, "--", *pathspecs, stdin=True, env=env)
+
+    def lines(self, parent, hexsha):
+        self.proc.stdin.write("{} {}\n{}\n".format(hexsha, parent, SENTINEL).encode("ascii"))
+        self.proc.stdin.flush()
+        lines = []
+        for line in self.proc.stdout:
+            line = line.decode("utf-8", "surrogateescape").rstrip("\n")
+            if line == SENTINEL:
+                if self.trace is not None:
+                    self.rename_time += read_rename_time(self.trace)
+                return lines
+            lines.append(line)
+        raise RuntimeError("git diff-tree stopped while diffing {}".format(hexsha))
+
+    def diff(self, parent, hexsha):
+        return parse_files(self.lines(parent, hexsha))
+
+    def entries(self, parent, hexsha):
+        return [parse_raw(line) for line in self.lines(parent, hexsha)]
+
+    def take_rename_time(self):
+        seconds, self.rename_time = self.rename_time, 0.0
+        return seconds
+
+    def close(self):
+        self.proc.stdin.close()
+        self.proc.wait()
+        if self.trace is not None:
+            self.trace.close()
+            os.unlink(self.trace_path)
+
+# Where git's rename detection (diffcore_rename) traces its regions
+RENAME_TRACE_FILE = "diffcore-rename.c"
+
+def read_rename_time(trace):
+    """Add up the rename detection regions in the trace2 events appended to TRACE since the last call."""
+    seconds = 0.0
+    for line in trace:
+        event = json.loads(line)
+        if event["event"] == "region_leave" and event.get("file") == RENAME_TRACE_FILE:
+            seconds += event["t_rel"]
+    return seconds
+
+def diff_tree_engine(repo, commits=None, variants=((),), pathspecs=(), blobs=False, merges="skip", renames=(), cache=None, cache_limit=DEFAULT_LIMIT, rename_timings=False):
+    """Feed every commit to one long-lived `git diff-tree --stdin` process per variant.
+
+    With a CACHE database, the files of every diff are listed first, and
+    only the diffs with blob pairs missing from the cache go to the variants.
+    With RENAME_TIMINGS, every CommitStat has the time git spent detecting
+    renames in all of its diffs.
+    """
+    raw_flags = RAW_FLAGS if blobs or cache else ()
+    with contextlib.ExitStack() as stack:
+        procs = []
+        for flags in variants:
+            procs.append(proc := DiffTree(repo, ("--numstat", *renames, *flags, *raw_flags), pathspecs, rename_timings))
+            stack.callback(proc.close)
+        diffs = [proc.diff for proc in procs]
+
+        if cache is not None:
+            listing = DiffTree(repo, (*RAW_FLAGS, *renames), pathspecs, rename_timings)
+            stack.callback(listing.close)
+            procs.append(listing)
+            pairs = PairCache(cache, cache_limit)
+            stack.callback(pairs.close)
+            # The variants (and the parents of a merge) share the listing of a diff
+            entries = functools.lru_cache(maxsize=8)(listing.entries)
+            diffs = [cached_diff(pairs, " ".join(("-M", *renames, *flags)), entries, diff) for flags, diff in zip(variants, diffs)]
+
+        for stat in diff_commits(iter_parents(repo, commits), diffs, merges):
+            if rename_timings:
+                stat = stat._replace(rename_time=sum(proc.take_rename_time() for proc in procs))
+            yield stat
+
+def cached_diff(pairs, options, entries, diff):
+    """Wrap DIFF to answer from the PAIRS cache whenever every blob pair of the diff is in it."""
+    def cached(parent, hexsha):
+        listed = entries(parent, hexsha)
+        stats = pairs.get([(entry.old_blob, entry.new_blob) for entry in listed], options)
+        if None not in stats:
+            return [
+                entry_stat(entry, num_additions, num_deletions)
+                for entry, (num_additions, num_deletions) in zip(listed, stats)
+                if not (is_droppable(entry) and num_additions == num_deletions == "0")
+            ]
+
+        files = diff(parent, hexsha)
+        # Files git left out are unchanged under these options
+        found = {(f.old_blob, f.new_blob) for f in files}
+        unchanged = [((entry.old_blob, entry.new_blob), ("0", "0")) for entry in listed if is_droppable(entry) and (entry.old_blob, entry.new_blob) not in found]
+        pairs.put([((f.old_blob, f.new_blob), (f.num_additions, f.num_deletions)) for f in files] + unchanged, options)
+        return files
+    return cached
+
+def log_engine(repo, commits=None, variants=((),), pathspecs=(), blobs=False, merges="skip", renames=()):
+    """Stream the numstat of the whole history from a single `git log` process per variant."""
+    if commits is not None:
+        commits = list(commits)
+    elif pathspecs:
+        # Pathspecs would also simplify the history walked by git log and
+        # rewrite the parents it reports, so list the commits up front
+        commits = list(iter_hexshas(repo))
+
+    # The logs of all variants list the same commits in the same order
+    raw_flags = RAW_FLAGS if blobs else ()
+    merge_flags = (MERGE_MODES[merges],) if MERGE_MODES[merges] else ()
+    logs = [log_numstat(repo, commits, (*renames, *flags, *raw_flags, *merge_flags), pathspecs, merges) for flags in variants]
+    for stats in zip(*logs, strict=True):
+        hexsha, parents, files, *_ = stats[0]
+        if any(stat.hexsha != hexsha for stat in stats):
+            raise RuntimeError("The logs of the diff variants are out of step at {}".format(hexsha))
+        if files is not None:
+            files = tuple(stat.files for stat in stats)
+        yield CommitStat(hexsha, parents, files)
+
+def log_numstat(repo, commits, flags, pathspecs=(), merges="skip"):
+    if commits is None:
+        proc = repo.popen("log", "--numstat", LOG_FORMAT, *flags, "--", *pathspecs)
+    else:
+        # git reads all of stdin before it starts walking, so this cannot block
+        proc = repo.popen("log", "--no-walk=unsorted", "--stdin", "--numstat", LOG_FORMAT, *flags, "--", *pathspecs, stdin=True)
+        proc.stdin.write("".join(hexsha + "\n" for hexsha in commits).encode("ascii"))
+        proc.stdin.close()
+    yield from parse_log(proc.stdout, merges)
+    proc.wait()
+
+def parse_log(lines, merges="skip"):
+    # With --diff-merges=separate a merge is listed once per parent, in
+    # parent order, so the consecutive diffs of a commit are grouped
+    header = None
+    for line in lines:
+        line = line.decode("utf-8", "surrogateescape").rstrip("\n")
+        if line.startswith("\0"):
+            if header is not None and line[1:].split() == header:
+                diffs.append([])
+                continue
+            if header is not None:
+                yield make_stat(header, diffs, merges)
+            header = line[1:].split()
+            diffs = [[]]
+        elif line:
+            diffs[-1].append(line)
+    if header is not None:
+        yield make_stat(header, diffs, merges)
+
+def make_stat(header, diffs, merges="skip"):
+    hexsha, *parents = header
+    # git log also reports the root commit against the empty tree
+    if not parents or (len(parents) > 1 and merges == "skip"):
+        return CommitStat(hexsha, parents, None)
+    if len(parents) > 1 and merges == "combined":
+        # Parents without a diff are not listed at all
+        if len(diffs) < len(parents):
+            return CommitStat(hexsha, parents, [])
+        return CommitStat(hexsha, parents, combine_diffs([parse_files(diff) for diff in diffs]))
+    return CommitStat(hexsha, parents, parse_files(diffs[0]))
+
+ENGINES = {
+    "diff": diff_engine,
+    "log": log_engine,
+    "diff-tree": diff_tree_engine,
+}
+
+def timed(stats):
+    """Set the seconds every CommitStat of the engine STATS took to compute."""
+    stats = iter(stats)
+    while True:
+        start = time.perf_counter()
+        stat = next(stats, None)
+        if stat is None:
+            return
+        yield stat._replace(seconds=time.perf_counter() - start)
+
+## Parallel numstat
+#
+# The commits are split into chunks that are diffed on a process pool, each
+# worker with its own repository handle. The results are yielded in the
+# original commit order, so the output is the same as a serial run. The
+# time the workers wait for git is added to the GitStats of the repository.
+
+# Commits per task
+CHUNK_SIZE = 256
+
+_worker_repo = None
+
+def init_worker(path):
+    global _worker_repo
+    _worker_repo = Repo(path)
+
+def numstat_chunk(engine, commits, options):
+    seconds, size = _worker_repo.stats.snapshot()
+    stats = list(timed(ENGINES[engine](_worker_repo, commits=commits, **options)))
+    return stats, _worker_repo.stats.seconds - seconds, _worker_repo.stats.bytes - size
+
+def parallel_engine(repo, engine, jobs, commits=None, **options):
+    def results(future):
+        stats, seconds, size = future.result()
+        repo.stats.add(seconds, size)
+        return stats
+
+    with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(repo.path,)) as executor:
+        pending = collections.deque()
+        hexshas = iter_hexshas(repo) if commits is None else iter(commits)
+        while chunk := list(itertools.islice(hexshas, CHUNK_SIZE)):
+            pending.append(executor.submit(numstat_chunk, engine, chunk, options))
+            # Keep a bounded number of chunks in flight
+            if len(pending) >= 2 * jobs:
+                yield from results(pending.popleft())
+        while pending:
+            yield from results(pending.popleft())
@@ -0,0 +1,74 @@
+import sqlite3
+
+## Persistent numstat of blob pairs
+#
+# The numstat of a file only depends on its blobs before and after the
+# change and on the diff options, so it is kept in an SQLite database keyed
+# by those, and shared between runs, branches and histories. A diff only
+# goes to git when one of its blob pairs has not been seen yet. Diff
+# attributes set per path in .gitattributes (such as -diff) are not part of
+# the key.
+
+# Pairs kept before the oldest ones are dropped
+DEFAULT_LIMIT = 1_000_000
+
+# Share of the pairs dropped at once when the limit is reached
+EVICT_FRACTION = 0.1
+
+# New pairs between two commits of the database
+COMMIT_EVERY = 1000
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS numstat (
+    old_blob TEXT NOT NULL,
+    new_blob TEXT NOT NULL,
+    options TEXT NOT NULL,
+    num_additions TEXT NOT NULL,
+    num_deletions TEXT NOT NULL,
+    PRIMARY KEY (old_blob, new_blob, options)
+)
+"""
+
+class PairCache:
+    """The numstat of (old blob, new blob) pairs, stored in the database at PATH.
+
+    Missing blobs (added or deleted files) are None. Once more than `limit`
+    pairs are stored, the oldest are dropped.
+    """
+    def __init__(self, path, limit=DEFAULT_LIMIT):
+        # Parallel workers share the database
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute(SCHEMA)
+        self.db.commit()
+        self.limit = limit
+        self.count = self.db.execute("SELECT COUNT(*) FROM numstat").fetchone()[0]
+        self.pending = 0
+
+    def get(self, pairs, options):
+        """Return (num_additions, num_deletions) for every pair in PAIRS, None for unseen ones."""
+        query = "SELECT num_additions, num_deletions FROM numstat WHERE old_blob = ? AND new_blob = ? AND options = ?"
+        return [self.db.execute(query, (old_blob or "", new_blob or "", options)).fetchone() for old_blob, new_blob in pairs]
+
+    def put(self, stats, options):
+        """Store STATS, a list of ((old blob, new blob), (num_additions, num_deletions))."""
+        cursor = self.db.executemany(
+            "INSERT OR IGNORE INTO numstat VALUES (?, ?, ?, ?, ?)",
+            [(old_blob or "", new_blob or "", options, num_additions, num_deletions) for (old_blob, new_blob), (num_additions, num_deletions) in stats],
+        )
+        self.count += cursor.rowcount
+        self.pending += cursor.rowcount
+        if self.pending >= COMMIT_EVERY:
+            self.commit()
+
+    def commit(self):
+        if self.count > self.limit:
+            drop = self.count - int(self.limit * (1 - EVICT_FRACTION))
+            self.db.execute("DELETE FROM numstat WHERE rowid IN (SELECT rowid FROM numstat ORDER BY rowid LIMIT ?)", (drop,))
+            self.count = self.db.execute("SELECT COUNT(*) FROM numstat").fetchone()[0]
+        self.db.commit()
+        self.pending = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
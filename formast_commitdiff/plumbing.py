@@ -0,0 +1,94 @@
+import os
+import subprocess
+import time
+
+## Git access without GitPython
+#
+# Everything commitdiff and diffstat need from git is plumbing: a few
+# long-lived processes (`cat-file --batch`, `rev-list`, `diff-tree --stdin`)
+# fed and read in raw bytes, and some one-off commands. Running them
+# directly skips importing GitPython and building its objects. A Repo also
+# keeps track of the time spent waiting for git and of the bytes git wrote,
+# see GitStats.
+
+class GitError(RuntimeError):
+    pass
+
+class GitStats:
+    """Seconds spent waiting for git (reading its output, or for it to exit) and bytes read from it."""
+    def __init__(self, seconds=0.0, size=0):
+        self.seconds = seconds
+        self.bytes = size
+
+    def add(self, seconds, size):
+        self.seconds += seconds
+        self.bytes += size
+
+    def snapshot(self):
+        return self.seconds, self.bytes
+
+class TimedReader:
+    """The stdout of a git process, adding the time spent reading it to a GitStats."""
+    def __init__(self, stream, stats):
+        self.stream = stream
+        self.stats = stats
+
+    def readline(self):
+        start = time.perf_counter()
+        line = self.stream.readline()
+        self.stats.add(time.perf_counter() - start, len(line))
+        return line
+
+    def read(self, size=-1):
+        start = time.perf_counter()
+        data = self.stream.read(size)
+        self.stats.add(time.perf_counter() - start, len(data))
+        return data
+
+    def __iter__(self):
+        return iter(self.readline, b"")
+
+    def close(self):
+        self.stream.close()
+
+class Process(subprocess.Popen):
+    """A git process whose wait() raises GitError when git failed."""
+    def __init__(self, args, stats, **kwargs):
+        super().__init__(args, **kwargs)
+        self.stats = stats
+        self.stdout = TimedReader(self.stdout, stats)
+
+    def wait(self, timeout=None):
+        start = time.perf_counter()
+        status = super().wait(timeout)
+        self.stats.add(time.perf_counter() - start, 0)
+        if status:
+            raise GitError("{} exited with status {}".format(" ".join(self.args[:2]), status))
+        return status
+
+class Repo:
+    """A git repository, at PATH or anywhere below its work tree."""
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        self.stats = GitStats()
+        if not os.path.isdir(self.path):
+            raise GitError("{} does not exist".format(path))
+        self.git_dir = self.run("rev-parse", "--absolute-git-dir").decode("utf-8", "surrogateescape").strip()
+
+    def popen(self, *args, stdin=False, env=None):
+        """Start `git ARGS`, with its stdout (and stdin, if asked for) as binary pipes.
+
+        ENV adds to the environment git runs in.
+        """
+        if env is not None:
+            env = {**os.environ, **env}
+        return Process(["git", *args], self.stats, cwd=self.path, stdin=subprocess.PIPE if stdin else subprocess.DEVNULL, stdout=subprocess.PIPE, env=env)
+
+    def run(self, *args):
+        """Run `git ARGS` and return its output, as bytes."""
+        start = time.perf_counter()
+        result = subprocess.run(["git", *args], cwd=self.path, stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self.stats.add(time.perf_counter() - start, len(result.stdout))
+        if result.returncode:
+            raise GitError("git {} failed: {}".format(args[0], result.stderr.decode("utf-8", "replace").strip()))
+        return result.stdout
@@ -1,5 +1,11 @@
+import asyncio
 import click
+import codecs
+import contextlib
+import functools
+import mmap
 import os
+import stat
 from tree_sitter import Language, Parser
 import sys
 import base64
@@ -7,6 +13,8 @@ import hashlib
 import logging
 from pathlib import Path
 
+from formast.server import serve
+
 log = logging.getLogger(__name__)
 
 ## Uncomment this block if you don't have the language file yet, first time running formast
@@ -33,80 +41,236 @@ JAVA_LANGUAGE = Language(str(language_file), 'java')
 @click.option("--writerelativeast", is_flag=True, help="Write the AST content with relative positions")
 @click.option("--writecompastsort", is_flag=True, help="Write the new file with the compressed AST content and sorted hashing")
 @click.option("--overwrite", is_flag=True, help="Overwrite the original .java file with the new content")
+@click.option("--skip-unchanged", is_flag=True, help="Do not rewrite the output file when it already has the same content")
+@click.option("--bytes", "use_bytes", is_flag=True, help="Build the output as bytes straight from the source, without str objects (always '\\n' line endings)")
+@click.option("--mmap", "use_mmap", is_flag=True, help="Memory-map the input and parse it through a read callback instead of reading it into memory (not with --writetoken, which reads its input as text)")
+@click.option("--serve", "serve_address", type=str, default=None, help="Serve the worker protocol with asyncio on '-' (stdin/stdout), 'host:port' or a unix socket path")
+@click.option("-j", "--jobs", type=int, default=None, help="Number of worker processes used by --serve (default: number of CPUs)")
+@click.option("--queue-size", type=int, default=16, show_default=True, help="Maximum number of requests in flight per client stream when serving")
+@click.option("--stdout", "to_stdout", is_flag=True, help="Stream the output to stdout instead of writing .ast files")
+@click.option("--fd", "output_fd", type=int, default=None, help="Stream the output to this file descriptor instead of writing .ast files")
 @click.option("-v", "--verbose", count=True, help="Increase output verbosity")
-@click.argument("file_path", type=str) 
+@click.argument("file_paths", nargs=-1, type=str) 
 
 ## Formast 
-def formast(file_path, writetoken, writeast, writerelativeast, writecompastsort, overwrite, verbose):
+def formast(file_paths, writetoken, writeast, writerelativeast, writecompastsort, overwrite, skip_unchanged, use_bytes, use_mmap, serve_address, jobs, queue_size, to_stdout, output_fd, verbose):
 
     # initialize logging
     logging.basicConfig(level=verbose)
 
+    if to_stdout and output_fd is not None:
+        raise click.UsageError("--stdout and --fd cannot be used together.")
+    streaming = to_stdout or output_fd is not None
+    if streaming and overwrite:
+        raise click.UsageError("--overwrite cannot be used when streaming the output.")
+    # A mapping holds the raw bytes, and the token format needs universal
+    # newlines before parsing: with "\r" line ends, comments run on
+    if use_mmap and writetoken:
+        raise click.UsageError("--mmap cannot be used with --writetoken.")
+
+    if serve_address is not None:
+        if streaming:
+            raise click.UsageError("--serve cannot be used when streaming the output.")
+        handle = functools.partial(process_in_worker, overwrite=overwrite, writetoken=writetoken, writeast=writeast, writerelativeast=writerelativeast, writecompastsort=writecompastsort, use_mmap=use_mmap, skip_unchanged=skip_unchanged, use_bytes=use_bytes)
+        asyncio.run(serve(serve_address, handle, jobs=jobs, queue_size=queue_size, initializer=init_worker))
+        return
+
+    if not file_paths:
+        raise click.UsageError("Missing argument 'FILE_PATHS...'.")
+
     log.debug("Using language file: %s", language_file)
     parser = Parser()
     parser.set_language(JAVA_LANGUAGE)
 
-    if (file_path == "-"):
+    output = None
+    if to_stdout:
+        output = sys.stdout.buffer
+    elif output_fd is not None:
+        output = os.fdopen(output_fd, "wb", closefd=False)
+
+    if file_paths == ("-",):
         while True:
             line = sys.stdin.readline()
             if not line:
                 break
-            process(Path(line.strip()), parser, overwrite, writetoken, writeast, writerelativeast, writecompastsort)
+            process(Path(line.strip()), parser, overwrite, writetoken, writeast, writerelativeast, writecompastsort, use_mmap, skip_unchanged, use_bytes, output, framed=True)
             log.info("processed %s" % line)
-            sys.stdout.write("ok\n")
-            sys.stdout.flush()
+            # A frame on stdout is the answer itself
+            if not to_stdout:
+                sys.stdout.write("ok\n")
+                sys.stdout.flush()
     else:
-        process(Path(file_path), parser, overwrite, writetoken, writeast, writerelativeast, writecompastsort)
+        # Several outputs on one stream are told apart by framing
+        framed = len(file_paths) > 1
+        for file_path in file_paths:
+            process(Path(file_path), parser, overwrite, writetoken, writeast, writerelativeast, writecompastsort, use_mmap, skip_unchanged, use_bytes, output, framed)
+
+## Worker processes used by --serve, each with its own parser
+_worker_parser = None
+
+def init_worker():
+    global _worker_parser
+    _worker_parser = Parser()
+    _worker_parser.set_language(JAVA_LANGUAGE)
+
+def process_in_worker(file_path, **options):
+    process(Path(file_path), _worker_parser, **options)
         
-def process(file_path, parser, overwrite, writetoken, writeast, writerelativeast, writecompastsort):
+def process(file_path, parser, overwrite, writetoken, writeast, writerelativeast, writecompastsort, use_mmap=False, skip_unchanged=False, use_bytes=False, output=None, framed=False):
 
     log.info(f"Processing {file_path}...")
     
     ## Handling options 
     # Token based
     if writetoken:  
-        with open(file_path, 'r', encoding='utf-8') as f:
-            src = f.read()
-        tree = parser.parse(src.encode("utf8"))
-        with open(file_path.with_suffix(".ast"),'w', encoding='utf-8') as f:
-            for node in traverse(tree):
-                if node.child_count == 0:
-                    f.write(node.text.decode('utf-8'))
-                    f.write("\n")
+        with open_source(file_path, use_mmap, text=True) as source:
+            tree = parse_source(parser, source)
+            if use_bytes:
+                data = process_tree_tokens_bytes(tree, source)
+            else:
+                data = encode_output(process_tree_tokens(tree, source))
     # AST based
     elif writeast:
-        with open(file_path, "rb") as f:
-            code = f.read()
-        tree = parser.parse(code)
-        ast_code = process_tree_ast(tree)
-        with open(file_path.with_suffix(".ast"), 'w', encoding='utf-8') as f:
-            f.write(ast_code)
+        with open_source(file_path, use_mmap) as source:
+            tree = parse_source(parser, source)
+            if use_bytes:
+                data = process_tree_ast_bytes(tree, source)
+            else:
+                data = encode_output(process_tree_ast(tree, source))
     # Sorted and compressed AST based
     elif writecompastsort:
-        with open(file_path, "rb") as f:
-            code = f.read()
-        tree = parser.parse(code)
-        ast_code = process_tree_comp_sorted(tree)
-        with open(file_path.with_suffix(".ast"), 'w', encoding='utf-8') as f:
-            f.write(ast_code)
+        with open_source(file_path, use_mmap) as source:
+            tree = parse_source(parser, source)
+            if use_bytes:
+                data = process_tree_comp_sorted_bytes(tree, source)
+            else:
+                data = encode_output(process_tree_comp_sorted(tree, source))
     # Relative AST based
     elif writerelativeast:
-        with open(file_path, "rb") as f:
-            code = f.read()
-        tree = parser.parse(code)
-        ast_code = process_tree_ast_relatively(tree)
-        with open(file_path.with_suffix(".ast"), 'w', encoding='utf-8') as f:
-            f.write(ast_code)
+        with open_source(file_path, use_mmap) as source:
+            tree = parse_source(parser, source)
+            if use_bytes:
+                data = process_tree_ast_relatively_bytes(tree, source)
+            else:
+                data = encode_output(process_tree_ast_relatively(tree, source))
+    else:
+        log.warning("No output format given, nothing to write for %s", file_path)
+        return
 
     log.info(f"Done with {file_path}...")
 
-    # If overwrite is true, overwrite the original .java file with the .ast content
-    if overwrite:
-        file_path.unlink()
-        os.rename(file_path.with_suffix('.ast'), file_path)
-        log.info("Original .java file overwritten with .ast content!")
-    
-    log.info("File saved!")
+    if output is not None:
+        write_stream(output, data, file_path if framed else None)
+        return
+
+    # If overwrite is true, overwrite the original .java file with the new content
+    target = file_path if overwrite else file_path.with_suffix(".ast")
+    if write_output(target, data, skip_unchanged):
+        log.info("File saved!")
+    else:
+        log.info("%s is unchanged, skipped writing it", target)
+
+## Output handling
+def encode_output(content):
+    # Match what a text mode file would have written
+    if os.linesep != "\n":
+        content = content.replace("\n", os.linesep)
+    return content.encode("utf-8")
+
+def write_stream(output, data, name=None):
+    """Write DATA to the binary stream OUTPUT.
+
+    With a NAME the data is framed like `git cat-file --batch` output, as
+    "<size> <name>\\n<data>\\n", so that several outputs can share a stream.
+    """
+    if name is not None:
+        output.write(b"%d %s\n" % (len(data), os.fsencode(name)))
+    output.write(data)
+    if name is not None:
+        output.write(b"\n")
+    output.flush()
+
+def write_output(target, data, skip_unchanged=False):
+    """Atomically replace TARGET with DATA.
+
+    The data is written to a temporary file next to the target, which is then
+    moved into place with os.replace, so the target is never missing. With
+    `skip_unchanged`, nothing is written if the target already holds the same
+    content. Returns whether the target was written.
+    """
+    try:
+        mode = stat.S_IMODE(os.stat(target).st_mode)
+    except FileNotFoundError:
+        mode = None
+    else:
+        if skip_unchanged and has_content(target, data):
+            return False
+
+    tmp = target.with_name(".{}.{}.tmp".format(target.name, os.getpid()))
+    try:
+        with open(tmp, "wb") as f:
+            f.write(data)
+        if mode is not None:
+            os.chmod(tmp, mode)
+        os.replace(tmp, target)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    return True
+
+def has_content(path, data):
+    if os.path.getsize(path) != len(data):
+        return False
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(READ_CHUNK):
+            digest.update(chunk)
+    return digest.digest() == hashlib.sha256(data).digest()
+
+## Source handling
+# Bytes handed to the parser per read callback, when parsing from a mapping
+READ_CHUNK = 64 * 1024
+
+@contextlib.contextmanager
+def open_source(file_path, use_mmap=False, text=False):
+    """Yield the source of a file, either as bytes or as a read-only mmap.
+
+    With `text` the file is read in text mode (universal newlines), as the
+    token format always has; a mapping cannot do that, as it yields the raw
+    bytes.
+    """
+    if text and use_mmap:
+        raise ValueError("A source read as text cannot be memory-mapped")
+    if not use_mmap:
+        if text:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                source = f.read().encode("utf8")
+        else:
+            with open(file_path, "rb") as f:
+                source = f.read()
+        yield source
+        return
+
+    with open(file_path, "rb") as f:
+        # Empty files cannot be mapped
+        if os.fstat(f.fileno()).st_size == 0:
+            yield b""
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as source:
+            yield source
+
+def parse_source(parser, source):
+    if isinstance(source, mmap.mmap):
+        # Feed the parser from the mapping instead of copying the whole file
+        return parser.parse(lambda byte, point: source[byte:byte + READ_CHUNK])
+    return parser.parse(source)
+
+def node_text(node, source=None):
+    # Trees parsed through a read callback do not keep their text, so slice
+    # the leaf out of the source it was parsed from.
+    if source is None:
+        return node.text
+    return source[node.start_byte:node.end_byte]
 
 ## Tree traversal function
 def traverse(tree):
@@ -126,8 +290,17 @@ def traverse(tree):
         else:
             break
 
+# Process the tree into its tokens, one leaf per line
+def process_tree_tokens(tree, source=None):
+    lines = []
+    for node in traverse(tree):
+        if node.child_count == 0:
+            lines.append(node_text(node, source).decode('utf-8'))
+            lines.append("\n")
+    return ''.join(lines)
+
 # Process the tree into an AST
-def process_tree_ast(tree):
+def process_tree_ast(tree, source=None):
     if tree is None:
         raise ValueError("The tree object must not be None")
 
@@ -148,7 +321,7 @@ def process_tree_ast(tree):
             line = 'B {} {}'.format(node.type, ' '.join(map(str, children)))
         else:
             try:
-                text = node.text.decode('utf-8')
+                text = node_text(node, source).decode('utf-8')
             except UnicodeDecodeError:
                 raise ValueError("The text of the leaf nodes must be encoded using utf-8")
             line = 'L {}'.format(text)
@@ -161,7 +334,7 @@ def process_tree_ast(tree):
     return '\n'.join(lines)
 
 ## Processes the tree relatively
-def process_tree_ast_relatively(tree):
+def process_tree_ast_relatively(tree, source=None):
     if tree is None:
         raise ValueError("The tree object must not be None")
 
@@ -182,7 +355,7 @@ def process_tree_ast_relatively(tree):
             line = 'B {} {}'.format(node.type, ' '.join(map(lambda x: str(x - len(lines)), children)))
         else:
             try:
-                text = node.text.decode('utf-8')
+                text = node_text(node, source).decode('utf-8')
             except UnicodeDecodeError:
                 raise ValueError("The text of the leaf nodes must be encoded using utf-8")
             line = 'L {}'.format(text)
@@ -195,7 +368,7 @@ def process_tree_ast_relatively(tree):
     return '\n'.join(lines)
 
 # Show every instance of the program just once as an AST, and hash the values
-def process_tree_comp_sorted(tree):
+def process_tree_comp_sorted(tree, source=None):
     if tree is None:
         raise ValueError("The tree object must not be None")
 
@@ -217,7 +390,7 @@ def process_tree_comp_sorted(tree):
             line = 'B {} {}'.format(node.type, ' '.join(map(str, children)))
         else:
             try:
-                text = node.text.decode('utf-8')
+                text = node_text(node, source).decode('utf-8')
             except UnicodeDecodeError:
                 raise ValueError("The text of the leaf nodes must be encoded using utf-8")
             line = 'L {}'.format(text)
@@ -238,6 +411,146 @@ def process_tree_comp_sorted(tree):
     sorted_lines = sorted(lines, key=lambda x: x.split()[0])
     return '\n'.join(sorted_lines)    
 
+## Bytes-native emitters
+# The same formats as above, built as bytes straight from the source slices so
+# that no str objects are made for leaf text or numbers. The output always
+# uses '\n' line endings.
+
+# Kind names, encoded once
+_kind_names = {}
+
+def kind_name(node):
+    name = node.type
+    encoded = _kind_names.get(name)
+    if encoded is None:
+        encoded = _kind_names[name] = name.encode('utf-8')
+    return encoded
+
+def check_utf8(source):
+    # Validate the whole source once instead of decoding every leaf, a chunk
+    # at a time so that no copy of it is made as a str
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    try:
+        with memoryview(source) as view:
+            for start in range(0, len(view), READ_CHUNK):
+                decoder.decode(view[start:start + READ_CHUNK])
+        decoder.decode(b"", final=True)
+    except UnicodeDecodeError:
+        raise ValueError("The text of the leaf nodes must be encoded using utf-8")
+
+def process_tree_tokens_bytes(tree, source):
+    check_utf8(source)
+    lines = []
+    for node in traverse(tree):
+        if node.child_count == 0:
+            lines.append(source[node.start_byte:node.end_byte])
+            lines.append(b"\n")
+    return b''.join(lines)
+
+def process_tree_ast_bytes(tree, source):
+    if tree is None:
+        raise ValueError("The tree object must not be None")
+    check_utf8(source)
+
+    lines = []
+
+    def process_node(node):
+        if node.children:
+            children = [process_node(child) for child in node.children]
+            line = b'B ' + kind_name(node) + b' ' + b' '.join(b'%d' % c for c in children)
+        else:
+            line = b'L ' + source[node.start_byte:node.end_byte]
+        lines.append(line)
+        return len(lines) - 1
+
+    process_node(tree.root_node)
+    return b'\n'.join(lines)
+
+def process_tree_ast_relatively_bytes(tree, source):
+    if tree is None:
+        raise ValueError("The tree object must not be None")
+    check_utf8(source)
+
+    lines = []
+
+    def process_node(node):
+        if node.children:
+            children = [process_node(child) for child in node.children]
+            n = len(lines)
+            line = b'B ' + kind_name(node) + b' ' + b' '.join(b'%d' % (c - n) for c in children)
+        else:
+            line = b'L ' + source[node.start_byte:node.end_byte]
+        lines.append(line)
+        return len(lines) - 1
+
+    process_node(tree.root_node)
+    return b'\n'.join(lines)
+
+def process_tree_comp_sorted_bytes(tree, source):
+    if tree is None:
+        raise ValueError("The tree object must not be None")
+    check_utf8(source)
+
+    lookup = {}
+    lines = []
+
+    def process_node_sorted(node):
+        if node.children:
+            children = [process_node_sorted(child) for child in node.children]
+            line = b'B ' + kind_name(node) + b' ' + b' '.join(children)
+        else:
+            line = b'L ' + source[node.start_byte:node.end_byte]
+
+        idx = lookup.get(line)
+        if idx is not None:
+            return idx
+
+        # The first 8 bytes of the digest, as process_tree_comp_sorted encodes them
+        idx = base64.urlsafe_b64encode(hashlib.sha256(line).digest()[:8]).rstrip(b'=')
+        lines.append(idx + b' ' + line)
+        lookup[line] = idx
+
+        return idx
+
+    process_node_sorted(tree.root_node)
+    sorted_lines = sorted(lines, key=lambda x: x.partition(b' ')[0])
+    return b'\n'.join(sorted_lines)
+
+## Formatting in memory
+# The formats by name, as (emitter, bytes emitter, whether the source is read
+# as text), for callers that already hold the source, such as a blob
+FORMATS = {
+    "token": (process_tree_tokens, process_tree_tokens_bytes, True),
+    "ast": (process_tree_ast, process_tree_ast_bytes, False),
+    "relative-ast": (process_tree_ast_relatively, process_tree_ast_relatively_bytes, False),
+    "comp-sorted-ast": (process_tree_comp_sorted, process_tree_comp_sorted_bytes, False),
+}
+
+def format_source(parser, source, fmt, use_bytes=False):
+    """Return the bytes `process` would write for the Java SOURCE in format FMT."""
+    emit, emit_bytes, text = FORMATS[fmt]
+    # Text formats are read with universal newlines, --bytes or not
+    if text:
+        source = universal_newlines(source)
+    tree = parse_source(parser, source)
+    if use_bytes:
+        return emit_bytes(tree, source)
+    return encode_output(emit(tree, source))
+
+def source_tokens(parser, source):
+    """Return the leaves of the Java SOURCE as a list of bytes.
+
+    These are the lines the token format would write, one per leaf, without
+    building the output; they are the same with --bytes or without.
+    """
+    source = universal_newlines(source)
+    tree = parse_source(parser, source)
+    return [node_text(node, source) for node in traverse(tree) if node.child_count == 0]
+
+def universal_newlines(source):
+    # As open_source reads the token format
+    return source.decode("utf-8").replace("\r\n", "\n").replace("\r", "\n").encode("utf-8")
+
 ## Check if the file is a java file
 def is_java_file(file_path):
     return os.path.splitext(file_path)[1] == '.java'
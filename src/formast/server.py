@@ -0,0 +1,147 @@
+import asyncio
+import logging
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+log = logging.getLogger(__name__)
+
+## Asyncio front end for the worker protocol
+#
+# The protocol is the same line protocol as `formast -`: every line is a path
+# to rewrite, and every request is answered, in order, with a single line:
+#
+#   ok               the file was processed
+#   cancelled        the request was cancelled before it started
+#   error <message>  processing failed
+#
+# A line of the form `!cancel <path>` cancels the oldest pending request for
+# <path> on the same stream. It is not answered itself. A request that has
+# already started runs to the end and is answered with its outcome.
+
+CANCEL_PREFIX = "!cancel "
+
+async def serve(address, handle, jobs=None, queue_size=16, initializer=None):
+    """Serve the worker protocol on ADDRESS until the input is closed.
+
+    ADDRESS is either "-" (stdin/stdout), "host:port" or a unix socket path.
+    `handle(path)` is run on a process pool with `jobs` workers, and every
+    stream may have at most `queue_size` requests in flight.
+    """
+    with ProcessPoolExecutor(max_workers=jobs, initializer=initializer) as executor:
+        async def on_client(reader, writer):
+            await handle_stream(reader, writer, executor, handle, queue_size)
+
+        if address == "-":
+            reader, writer = await open_stdio()
+            await on_client(reader, writer)
+            return
+
+        host, sep, port = address.rpartition(":")
+        if sep and port.isdigit():
+            server = await asyncio.start_server(on_client, host or None, int(port))
+        else:
+            server = await asyncio.start_unix_server(on_client, address)
+
+        log.info("Serving on %s", address)
+        async with server:
+            await server.serve_forever()
+
+async def handle_stream(reader, writer, executor, handle, queue_size):
+    queue = asyncio.Queue(maxsize=queue_size)
+    pending = {}
+
+    async def read_requests():
+        while line := await reader.readline():
+            line = line.decode("utf-8").strip()
+            if not line:
+                continue
+            if line.startswith(CANCEL_PREFIX):
+                cancel(line[len(CANCEL_PREFIX):])
+                continue
+            # A concurrent future, whose cancel() fails once the job has
+            # started; an asyncio future would claim to cancel a running job
+            future = executor.submit(handle, line)
+            pending.setdefault(line, deque()).append(future)
+            # Blocks when the stream has too many requests in flight, which
+            # stops us from reading more from the client (backpressure).
+            await queue.put((line, future))
+        await queue.put(None)
+
+    def cancel(path):
+        for future in pending.get(path, ()):
+            if future.cancel():
+                log.info("cancelled %s", path)
+                return
+        log.info("nothing to cancel for %s", path)
+
+    async def write_responses():
+        while (item := await queue.get()) is not None:
+            path, future = item
+            await asyncio.wait((asyncio.wrap_future(future),))
+
+            futures = pending[path]
+            futures.remove(future)
+            if not futures:
+                del pending[path]
+
+            if future.cancelled():
+                response = "cancelled"
+            elif (e := future.exception()) is not None:
+                log.error("failed to process %s: %s", path, e)
+                response = "error {}".format(" ".join(str(e).split()))
+            else:
+                response = "ok"
+                log.info("processed %s", path)
+            writer.write((response + "\n").encode("utf-8"))
+            await writer.drain()
+
+    reading = asyncio.create_task(read_requests())
+    writing = asyncio.create_task(write_responses())
+    try:
+        # When either side fails, the other one would wait forever
+        await asyncio.wait((reading, writing), return_when=asyncio.FIRST_EXCEPTION)
+    finally:
+        for task in (reading, writing):
+            task.cancel()
+        # Once reading has stopped, no more requests are submitted
+        await asyncio.gather(reading, writing, return_exceptions=True)
+        for futures in pending.values():
+            for future in futures:
+                future.cancel()
+        writer.close()
+
+    for task in (reading, writing):
+        if task.cancelled() or (e := task.exception()) is None:
+            continue
+        # A client may go away without reading its answers
+        if not isinstance(e, ConnectionError):
+            raise e
+        log.info("client disconnected: %s", e)
+
+async def open_stdio():
+    # Pipe transports do not work for regular files or on Windows consoles, so
+    # the stdio stream does its blocking reads and writes on a helper thread.
+    return StdioReader(), StdioWriter()
+
+class StdioReader:
+    async def readline(self):
+        return await asyncio.to_thread(sys.stdin.buffer.readline)
+
+class StdioWriter:
+    def __init__(self):
+        self.buffer = []
+
+    def write(self, data):
+        self.buffer.append(data)
+
+    async def drain(self):
+        data, self.buffer = b"".join(self.buffer), []
+        await asyncio.to_thread(self._flush, data)
+
+    def _flush(self, data):
+        sys.stdout.buffer.write(data)
+        sys.stdout.buffer.flush()
+
+    def close(self):
+        pass
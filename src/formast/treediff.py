@@ -0,0 +1,131 @@
+import collections
+import difflib
+
+## Structural diff of two syntax trees
+#
+# Counts how many subtrees were inserted, deleted or moved between two
+# versions of a file, on their tree-sitter trees. Every subtree is
+# identified like a line of process_tree_comp_sorted: a leaf by its text, an
+# inner node by its kind and the identities of its children, hashed here
+# instead of written out, so identical subtrees are found in constant time.
+#
+# The trees are matched top-down from their roots. The children of two
+# matched nodes are aligned by identity; identical children are matched as a
+# whole, and unequal inner children of the same kind in between are matched
+# to each other and aligned in turn. What is left are deleted and inserted
+# subtrees, except that identical subtrees among them are matched anywhere
+# in the trees, as moved. An edited leaf counts as one deleted and one
+# inserted subtree.
+
+# Smallest subtree (in nodes) matched as moved; single tokens such as ";"
+# are everywhere
+MIN_MOVED_SIZE = 2
+
+TreeDiff = collections.namedtuple("TreeDiff", ["inserted", "deleted", "moved"])
+
+class FlatTree:
+    """A syntax tree as lists indexed by node, in post-order.
+
+    `hashes` identify subtrees, `sizes` count their nodes, and `children`
+    and `parents` link them (the root has no parent).
+    """
+    def __init__(self, tree, source=None):
+        self.kinds = []
+        self.hashes = []
+        self.sizes = []
+        self.children = []
+        self.parents = []
+
+        def flatten(node):
+            if node.children:
+                children = [flatten(child) for child in node.children]
+                node_hash = hash((node.type, *(self.hashes[child] for child in children)))
+                size = 1 + sum(self.sizes[child] for child in children)
+            else:
+                children = []
+                text = node.text if source is None else source[node.start_byte:node.end_byte]
+                node_hash = hash((None, bytes(text)))
+                size = 1
+            index = len(self.hashes)
+            self.kinds.append(node.type)
+            self.hashes.append(node_hash)
+            self.sizes.append(size)
+            self.children.append(children)
+            self.parents.append(None)
+            for child in children:
+                self.parents[child] = index
+            return index
+
+        self.root = flatten(tree.root_node)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def subtree(self, node):
+        # The nodes of the subtree under NODE, in post-order
+        return range(node - self.sizes[node] + 1, node + 1)
+
+def tree_diff(old, new):
+    """Return the TreeDiff between the FlatTrees OLD and NEW."""
+    old_partner = [None] * len(old)
+    new_partner = [None] * len(new)
+
+    def match_subtree(o, n):
+        # Identical subtrees have the same shape, node for node
+        for a, b in zip(old.subtree(o), new.subtree(n)):
+            old_partner[a] = b
+            new_partner[b] = a
+
+    # Top-down, from the roots
+    pending = []
+    if old.kinds[old.root] == new.kinds[new.root]:
+        old_partner[old.root] = new.root
+        new_partner[new.root] = old.root
+        pending.append((old.root, new.root))
+    while pending:
+        o, n = pending.pop()
+        old_children, new_children = old.children[o], new.children[n]
+        matcher = difflib.SequenceMatcher(None, [old.hashes[c] for c in old_children], [new.hashes[c] for c in new_children], autojunk=False)
+        i = j = 0
+        for block in matcher.get_matching_blocks():
+            # Pair the unequal inner children of the same kind in the gap before the block
+            k = j
+            for a in old_children[i:block.a]:
+                for l in range(k, block.b):
+                    b = new_children[l]
+                    if old.kinds[a] == new.kinds[b] and old.children[a] and new.children[b]:
+                        old_partner[a] = b
+                        new_partner[b] = a
+                        pending.append((a, b))
+                        k = l + 1
+                        break
+            for a, b in zip(old_children[block.a:block.a + block.size], new_children[block.b:block.b + block.size]):
+                match_subtree(a, b)
+            i, j = block.a + block.size, block.b + block.size
+
+    # Identical subtrees among the rest moved, largest first
+    candidates = collections.defaultdict(list)
+    for n in reversed(range(len(new))):
+        if new_partner[n] is None and new.sizes[n] >= MIN_MOVED_SIZE:
+            candidates[new.hashes[n]].append(n)
+    moved = 0
+    for o in sorted(range(len(old)), key=lambda o: -old.sizes[o]):
+        if old_partner[o] is not None or old.sizes[o] < MIN_MOVED_SIZE:
+            continue
+        others = candidates.get(old.hashes[o])
+        while others and new_partner[others[-1]] is not None:
+            others.pop()
+        if others:
+            match_subtree(o, others.pop())
+            moved += 1
+
+    # Count the roots of what is left unmatched
+    def unmatched_roots(tree, partner):
+        return sum(1 for node in range(len(tree)) if partner[node] is None and (tree.parents[node] is None or partner[tree.parents[node]] is not None))
+    return TreeDiff(unmatched_roots(new, new_partner), unmatched_roots(old, old_partner), moved)
+
+def diff_sources(parser, old, new):
+    """Return the TreeDiff between the sources OLD and NEW, as bytes (None for no file)."""
+    old = old or b""
+    new = new or b""
+    return tree_diff(FlatTree(parser.parse(old), old), FlatTree(parser.parse(new), new))
@@ -0,0 +1,112 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+# The commitdiff scripts import each other as top-level modules, and formast
+# from src
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "formast_commitdiff"))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), os.pardir, "src"))
+
+GIT_ENV = {
+    "GIT_AUTHOR_NAME": "Test",
+    "GIT_AUTHOR_EMAIL": "test@example.com",
+    "GIT_COMMITTER_NAME": "Test",
+    "GIT_COMMITTER_EMAIL": "test@example.com",
+    "GIT_CONFIG_NOSYSTEM": "1",
+    "HOME": os.devnull,
+}
+
+def git(path, *args):
+    return subprocess.run(["git", *args], cwd=path, env={**os.environ, **GIT_ENV}, check=True, stdout=subprocess.PIPE).stdout
+
+def write(path, name, data):
+    with open(os.path.join(path, name), "wb") as f:
+        f.write(data)
+
+def commit(path, message):
+    git(path, "add", "-A")
+    git(path, "commit", "-q", "-m", message)
+    return git(path, "rev-parse", "HEAD").decode("ascii").strip()
+
+# A Java file long enough to be detected as renamed after a small edit
+MAIN = b"".join(b"    int f%d() { return %d; }\n" % (i, i) for i in range(20))
+
+@pytest.fixture(scope="session")
+def repo(tmp_path_factory):
+    """A small repository with a rename, a binary file, a whitespace-only change and a merge.
+
+    Returns its path and the commits by name.
+    """
+    path = str(tmp_path_factory.mktemp("repo"))
+    git(path, "init", "-q", "-b", "main")
+    commits = {}
+
+    write(path, "Main.java", b"class Main {\n" + MAIN + b"}\n")
+    write(path, "README", b"one\ntwo\n")
+    commits["root"] = commit(path, "root")
+
+    git(path, "mv", "Main.java", "App.java")
+    write(path, "App.java", b"class App {\n" + MAIN + b"}\n")
+    commits["rename"] = commit(path, "rename")
+
+    write(path, "logo.bin", bytes(range(256)))
+    commits["binary"] = commit(path, "binary")
+
+    write(path, "README", b"one\n  two  \n")
+    commits["whitespace"] = commit(path, "whitespace")
+
+    git(path, "checkout", "-q", "-b", "side", commits["binary"])
+    write(path, "NOTES", b"side\n")
+    commits["side"] = commit(path, "side")
+
+    git(path, "checkout", "-q", "main")
+    git(path, "merge", "-q", "--no-ff", "-m", "merge", "side")
+    commits["merge"] = git(path, "rev-parse", "HEAD").decode("ascii").strip()
+    return path, commits
+
+@pytest.fixture(scope="session")
+def submodule_repo(tmp_path_factory):
+    """A repository with a submodule added and then moved to another commit.
+
+    The submodule commits are not in the repository, as with any clone that
+    did not fetch its submodules. Returns its path and the commits by name.
+    """
+    path = str(tmp_path_factory.mktemp("submodule"))
+    git(path, "init", "-q", "-b", "main")
+    commits = {}
+
+    write(path, "README", b"one\n")
+    commits["root"] = commit(path, "root")
+
+    # Committed from the index, as the work tree has no lib directory
+    write(path, "README", b"one\ntwo\n")
+    git(path, "add", "README")
+    git(path, "update-index", "--add", "--cacheinfo", "160000,{},lib".format("1" * 40))
+    git(path, "commit", "-q", "-m", "add")
+    commits["add"] = git(path, "rev-parse", "HEAD").decode("ascii").strip()
+
+    git(path, "update-index", "--cacheinfo", "160000,{},lib".format("2" * 40))
+    git(path, "commit", "-q", "-m", "move")
+    commits["move"] = git(path, "rev-parse", "HEAD").decode("ascii").strip()
+    return path, commits
+
+# Versions of a Java file: reformatted, then a method added, then one moved
+SHOP = [
+    b"class Shop {\n    int price(int n) {\n        return n * 2;\n    }\n\n    int tax(int n) {\n        return n / 10;\n    }\n}\n",
+    b"class Shop\n{\n  int price(int n)\n  {\n    return n*2;\n  }\n  int tax(int n) { return n/10; }\n}\n",
+    b"class Shop\n{\n  int price(int n)\n  {\n    return n*2;\n  }\n  int tax(int n) { return n/10; }\n  int total(int n) { return price(n) + tax(n); }\n}\n",
+    b"class Shop\n{\n  int tax(int n) { return n/10; }\n  int total(int n) { return price(n) + tax(n); }\n  int price(int n)\n  {\n    return n*2;\n  }\n}\n",
+]
+
+@pytest.fixture(scope="session")
+def java_repo(tmp_path_factory):
+    """A repository changing one Java file, see SHOP. Returns its path and the commits by name."""
+    path = str(tmp_path_factory.mktemp("java"))
+    git(path, "init", "-q", "-b", "main")
+    commits = {}
+    for name, source in zip(["root", "reformat", "add", "move"], SHOP):
+        write(path, "Shop.java", source)
+        commits[name] = commit(path, name)
+    return path, commits
@@ -0,0 +1,26 @@
+import mmap
+
+import pytest
+
+from formast.__main__ import READ_CHUNK, check_utf8
+
+# Two-byte characters, one of them split by every chunk boundary
+SOURCE = ("é" * READ_CHUNK + "x€").encode("utf-8")
+
+def test_valid():
+    check_utf8(SOURCE)
+    check_utf8(b"")
+
+@pytest.mark.parametrize("source", [SOURCE[:-1], b"\xff" + SOURCE, SOURCE[:READ_CHUNK - 1] + b"\xff" + SOURCE[READ_CHUNK:]], ids=["truncated", "start", "chunk boundary"])
+def test_invalid(source):
+    with pytest.raises(ValueError):
+        check_utf8(source)
+
+def test_mmap(tmp_path):
+    path = tmp_path / "Source.java"
+    path.write_bytes(SOURCE)
+    with open(path, "rb") as f:
+        source = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        check_utf8(source)
+        # No view of the mapping is left behind
+        source.close()
@@ -0,0 +1,45 @@
+import os
+
+from checkpoint import checkpoint_path, load_checkpoint
+
+HEADER = "commit_hash,num_additions,num_deletions,filename\n"
+ROW_A = "a" * 40 + ",1,0,README\n"
+ROW_B = "b" * 40 + ",2,1,Main.java\n"
+
+def write(path, text, mtime_ns):
+    path.write_text(text)
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+def checkpoint(output, lines, mtime_ns):
+    write(output.parent / checkpoint_path(output.name), "".join("{} {}\n".format(hexsha, offset) for hexsha, offset in lines), mtime_ns)
+
+def test_checkpoint(tmp_path):
+    output = tmp_path / "out.csv"
+    write(output, HEADER + ROW_A, 1_000)
+    checkpoint(output, [("a" * 40, len(HEADER + ROW_A)), ("c" * 40, len(HEADER + ROW_A))], 2_000)
+    assert load_checkpoint(str(output)) == ({"a" * 40, "c" * 40}, len(HEADER + ROW_A))
+
+def test_rows_after_a_crash(tmp_path):
+    # Written after the last checkpoint, and cut off by the resumed run
+    output = tmp_path / "out.csv"
+    write(output, HEADER + ROW_A + ROW_B[:10], 3_000)
+    checkpoint(output, [("a" * 40, len(HEADER + ROW_A))], 2_000)
+    assert load_checkpoint(str(output)) == ({"a" * 40}, len(HEADER + ROW_A))
+
+def test_csv_shorter_than_checkpoint(tmp_path):
+    output = tmp_path / "out.csv"
+    write(output, HEADER + ROW_B, 3_000)
+    checkpoint(output, [("a" * 40, len(HEADER + ROW_A + ROW_B))], 2_000)
+    assert load_checkpoint(str(output)) == ({"b" * 40}, len(HEADER + ROW_B))
+
+def test_offset_within_a_row(tmp_path):
+    output = tmp_path / "out.csv"
+    write(output, HEADER + ROW_B + ROW_A, 3_000)
+    checkpoint(output, [("a" * 40, len(HEADER + ROW_A))], 2_000)
+    assert load_checkpoint(str(output)) == ({"a" * 40, "b" * 40}, len(HEADER + ROW_B + ROW_A))
+
+def test_csv_rewritten_after_checkpoint(tmp_path):
+    output = tmp_path / "out.csv"
+    write(output, HEADER + ROW_B, 3_000)
+    checkpoint(output, [("a" * 40, len(HEADER + ROW_B))], 2_000)
+    assert load_checkpoint(str(output)) == ({"b" * 40}, len(HEADER + ROW_B))
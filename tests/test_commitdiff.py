@@ -0,0 +1,71 @@
+import pytest
+from click.testing import CliRunner
+
+from commitdiff import main
+
+def run(repo, tmp_path, *args):
+    path, _ = repo
+    output = tmp_path / "out.csv"
+    result = CliRunner().invoke(main, [path, str(output), *args], catch_exceptions=False)
+    assert result.exit_code == 0, result.output
+    return output.read_text()
+
+OPTIONS = [
+    (),
+    ("-w",),
+    ("--sizes", "--paths"),
+    ("--sizes", "-w"),
+    ("--typed",),
+    ("--merges", "first-parent"),
+    ("--merges", "combined"),
+    ("--no-renames",),
+]
+
+@pytest.mark.parametrize("options", OPTIONS, ids=" ".join)
+def test_engines_agree(repo, tmp_path, options):
+    expected = run(repo, tmp_path, "--engine", "diff", *options)
+    assert run(repo, tmp_path, "--engine", "log", *options) == expected
+    assert run(repo, tmp_path, "--engine", "diff-tree", *options) == expected
+    assert run(repo, tmp_path, "--engine", "diff-tree", "-j", "2", *options) == expected
+    cache = str(tmp_path / "cache.db")
+    # Once filling the cache and once answering from it
+    assert run(repo, tmp_path, "--cache", cache, *options) == expected
+    assert run(repo, tmp_path, "--cache", cache, *options) == expected
+
+def test_rows(repo, tmp_path):
+    _, commits = repo
+    rows = run(repo, tmp_path, "--paths", "--merges", "first-parent").splitlines()
+    assert rows == [
+        "commit_hash,num_additions,num_deletions,filename,old_path,new_path",
+        commits["merge"] + ",1,0,NOTES,,NOTES",
+        commits["whitespace"] + ",1,1,README,README,README",
+        commits["side"] + ",1,0,NOTES,,NOTES",
+        commits["binary"] + ",-,-,logo.bin,,logo.bin",
+        commits["rename"] + ",1,1,Main.java => App.java,Main.java,App.java",
+    ]
+
+def test_whitespace_only_change_is_dropped(repo, tmp_path):
+    _, commits = repo
+    assert commits["whitespace"] not in run(repo, tmp_path, "-w", "--sizes")
+
+@pytest.mark.parametrize("engine", ["diff", "log", "diff-tree", "cache"])
+def test_submodule_sizes(submodule_repo, tmp_path, engine):
+    _, commits = submodule_repo
+    if engine == "cache":
+        options = ("--cache", str(tmp_path / "cache.db"))
+    else:
+        options = ("--engine", engine)
+    rows = run(submodule_repo, tmp_path, *options, "--sizes").splitlines()
+    assert [row.split(",")[:4] + row.split(",")[-2:] for row in rows[1:]] == [
+        [commits["move"], "1", "1", "lib", "0", "0"],
+        [commits["add"], "1", "0", "README", "4", "8"],
+        [commits["add"], "1", "0", "lib", "0", "0"],
+    ]
+
+def test_incremental_after_the_csv_was_rewritten(repo, tmp_path):
+    expected = run(repo, tmp_path).splitlines()
+    # Written over by hand, leaving the checkpoint of the full run behind
+    (tmp_path / "out.csv").write_text("\n".join(expected[:2]) + "\n")
+    rows = run(repo, tmp_path, "--incremental").splitlines()
+    assert rows[:2] == expected[:2]
+    assert sorted(rows) == sorted(expected)
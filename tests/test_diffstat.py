@@ -0,0 +1,60 @@
+import pytest
+from click.testing import CliRunner
+
+from commitdiff import main as commitdiff
+from diffstat import main
+
+def run(repo, *args, command=main):
+    path, _ = repo
+    result = CliRunner().invoke(command, [path, *args], catch_exceptions=False)
+    assert result.exit_code == 0, result.output
+
+def rows(path):
+    return path.read_text().splitlines()[1:]
+
+@pytest.mark.parametrize("fmt", ["java", "token", "ast"])
+def test_submodule(submodule_repo, tmp_path, fmt):
+    _, commits = submodule_repo
+    output = tmp_path / "out.csv"
+    run(submodule_repo, "--format", fmt, str(output))
+    # Like git, a submodule is diffed as its "Subproject commit <id>" line
+    assert rows(output) == [
+        commits["move"] + ",1,1,lib",
+        commits["add"] + ",1,0,README",
+        commits["add"] + ",1,0,lib",
+    ]
+
+FORMATS = ["java", "token", "ast", "relative-ast", "comp-sorted-ast"]
+
+@pytest.mark.parametrize("options", [(), ("-w",), ("--merges", "first-parent")], ids=" ".join)
+@pytest.mark.parametrize("fmt", FORMATS)
+def test_other_files_as_commitdiff(repo, tmp_path, fmt, options):
+    # Only Java files are formatted, the others are diffed as git does
+    output = tmp_path / "out.csv"
+    expected = tmp_path / "expected.csv"
+    run(repo, "--format", fmt, str(output), *options)
+    run(repo, str(expected), *options, command=commitdiff)
+    assert [row for row in rows(output) if ".java" not in row] == [row for row in rows(expected) if ".java" not in row]
+
+def test_formats(java_repo, tmp_path):
+    _, commits = java_repo
+    outputs = {fmt: tmp_path / (fmt + ".csv") for fmt in FORMATS}
+    run(java_repo, *(arg for fmt, output in outputs.items() for arg in ("--format", fmt, str(output))))
+    # The java format is the file as it is
+    assert rows(outputs["java"]) == [
+        commits["move"] + ",2,2,Shop.java",
+        commits["add"] + ",1,0,Shop.java",
+        commits["reformat"] + ",7,8,Shop.java",
+    ]
+    # The others do not see the reformatting
+    for fmt in FORMATS[1:]:
+        changed = [row.split(",")[0] for row in rows(outputs[fmt])]
+        assert changed == [commits["move"], commits["add"]], fmt
+
+@pytest.mark.parametrize("fmt", FORMATS)
+def test_bytes(java_repo, tmp_path, fmt):
+    text = tmp_path / "text.csv"
+    data = tmp_path / "bytes.csv"
+    run(java_repo, "--format", fmt, str(text))
+    run(java_repo, "--format", fmt, str(data), "--bytes")
+    assert rows(data) == rows(text)
@@ -0,0 +1,104 @@
+import random
+import subprocess
+
+import pytest
+
+from linediff import numstat
+
+def git_numstat(tmp_path, old, new, flags=()):
+    (tmp_path / "old").write_bytes(old)
+    (tmp_path / "new").write_bytes(new)
+    result = subprocess.run(["git", "diff", "--no-index", "--numstat", *flags, "old", "new"], cwd=tmp_path, stdout=subprocess.PIPE, check=False)
+    assert result.returncode in (0, 1)
+    if not result.stdout:
+        return 0, 0
+    num_additions, num_deletions, _ = result.stdout.decode("ascii").split("\t")
+    if num_additions == "-":
+        return None
+    return int(num_additions), int(num_deletions)
+
+FLAGS = [(), ("--ignore-all-space",), ("--ignore-space-change",)]
+
+EDGE_CASES = [
+    (b"", b""),
+    (b"", b"a\n"),
+    (b"a\n", b""),
+    (b"a\nb\n", b"a\nb\n"),
+    # No final newline
+    (b"a\nb", b"a\nb\n"),
+    (b"a\nb\n", b"a\nb"),
+    (b"a", b"b"),
+    (b"a\n\n\n", b"a\n\n"),
+    # Whitespace only
+    (b"a b\n", b"a  b\n"),
+    (b"a b\n", b"ab\n"),
+    (b"a\n", b"a \n"),
+    (b"a\r\n", b"a\n"),
+    (b"\tif (x) {\n\t}\n", b"    if (x) {\n    }\n"),
+    (b"a\n\nb\n", b"a\n \nb\n"),
+    # Binary
+    (b"a\0b\n", b"a\n"),
+    (b"a\n", b"\0"),
+]
+
+@pytest.mark.parametrize("flags", FLAGS, ids=" ".join)
+@pytest.mark.parametrize("old, new", EDGE_CASES)
+def test_edge_cases(tmp_path, old, new, flags):
+    assert numstat(old, new, flags) == git_numstat(tmp_path, old, new, flags)
+
+def random_lines(rng, n, alphabet):
+    return [rng.choice(alphabet) for _ in range(n)]
+
+def edit(rng, lines, alphabet, edits):
+    lines = list(lines)
+    for _ in range(edits):
+        i = rng.randrange(len(lines) + 1)
+        kind = rng.randrange(3)
+        if kind == 0:
+            lines.insert(i, rng.choice(alphabet))
+        elif lines and kind == 1:
+            del lines[i - 1]
+        elif lines:
+            lines[i - 1] = rng.choice(alphabet)
+    return lines
+
+def alphabet(size):
+    # With spacing variants, which the whitespace flags treat alike
+    words = [b"x%d" % i for i in range(size)]
+    return [b"%s%s;\n" % (space, word) for word in words for space in (b"", b" ", b"\t")]
+
+@pytest.mark.parametrize("seed", range(20))
+@pytest.mark.parametrize("flags", FLAGS, ids=" ".join)
+def test_random_small(tmp_path, seed, flags):
+    rng = random.Random(seed)
+    lines = alphabet(rng.randrange(2, 8))
+    old = random_lines(rng, rng.randrange(0, 60), lines)
+    new = edit(rng, old, lines, rng.randrange(0, 20))
+    old, new = b"".join(old), b"".join(new)
+    if rng.randrange(4) == 0:
+        new = new.rstrip(b"\n")
+    assert numstat(old, new, flags) == git_numstat(tmp_path, old, new, flags)
+
+@pytest.mark.parametrize("seed", range(4))
+def test_random_large(tmp_path, seed):
+    # Unrelated files, costly enough for the search to settle for a good
+    # enough split (mxcost), with lines having many matches
+    rng = random.Random(seed)
+    lines = alphabet(20)
+    old = b"".join(random_lines(rng, 3000, lines))
+    new = b"".join(random_lines(rng, 3000, lines))
+    assert numstat(old, new) == git_numstat(tmp_path, old, new)
+
+def test_long_snakes(tmp_path):
+    # Blocks of lines swapped around, giving long runs of common lines among
+    # many changes. The search only follows them once the edit cost passes
+    # HEUR_MIN_COST while staying under mxcost, which takes 2 * 4**8 lines.
+    rng = random.Random(0)
+    old = [b"line %d\n" % i for i in range(34000)]
+    blocks = [old[i:i + 30] for i in range(0, len(old), 30)]
+    for i in range(0, len(blocks) - 1, 2):
+        if rng.randrange(2):
+            blocks[i], blocks[i + 1] = blocks[i + 1], blocks[i]
+    new = [line for block in blocks for line in block[rng.randrange(0, 3):]]
+    old, new = b"".join(old), b"".join(new)
+    assert numstat(old, new) == git_numstat(tmp_path, old, new)
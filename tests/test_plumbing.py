@@ -0,0 +1,66 @@
+import pytest
+
+import catfile
+from catfile import BatchCheck, CatFile
+from numstat import DiffTree, NULL_OID
+from plumbing import GitError, Repo
+
+def test_run(repo):
+    path, commits = repo
+    r = Repo(path)
+    assert r.run("rev-parse", "main").decode("ascii").strip() == commits["merge"]
+    assert r.stats.bytes > 0
+
+def test_run_fails(repo):
+    path, _ = repo
+    with pytest.raises(GitError):
+        Repo(path).run("rev-parse", "--verify", "no-such-ref")
+
+def test_cat_file_read(repo):
+    path, commits = repo
+    r = Repo(path)
+    cat = CatFile(r)
+    try:
+        readme = r.run("rev-parse", commits["whitespace"] + ":README").decode("ascii").strip()
+        logo = r.run("rev-parse", commits["binary"] + ":logo.bin").decode("ascii").strip()
+        assert cat.read(readme) == b"one\n  two  \n"
+        # Contents are read whole, newlines and NUL bytes included
+        assert cat.read(logo) == bytes(range(256))
+        assert cat.read(readme) == b"one\n  two  \n"
+        with pytest.raises(RuntimeError):
+            cat.read(NULL_OID)
+    finally:
+        cat.close()
+
+def test_batch_check_sizes_past_the_cache_limit(repo, monkeypatch):
+    path, _ = repo
+    r = Repo(path)
+    oids = r.run("rev-list", "--objects", "--all", "--no-object-names").decode("ascii").split()
+    expected = [int(r.run("cat-file", "-s", oid)) for oid in oids]
+    monkeypatch.setattr(catfile, "CACHE_LIMIT", 5)
+    batch = BatchCheck(r)
+    try:
+        assert batch.sizes(oids[:3]) == expected[:3]
+        # Drops the cache, including the sizes it needs again
+        assert batch.sizes(oids[:6]) == expected[:6]
+        assert batch.sizes([None, oids[0]]) == [0, expected[0]]
+    finally:
+        batch.close()
+
+def test_diff_tree_lines(repo):
+    path, commits = repo
+    diff_tree = DiffTree(Repo(path), ("--numstat",))
+    try:
+        assert diff_tree.lines(commits["root"], commits["rename"]) == ["1\t1\tMain.java => App.java"]
+        assert diff_tree.lines(commits["rename"], commits["binary"]) == ["-\t-\tlogo.bin"]
+        assert diff_tree.lines(commits["binary"], commits["whitespace"]) == ["1\t1\tREADME"]
+    finally:
+        diff_tree.close()
+
+def test_diff_tree_ignores_whitespace(repo):
+    path, commits = repo
+    diff_tree = DiffTree(Repo(path), ("--numstat", "-w"))
+    try:
+        assert diff_tree.lines(commits["binary"], commits["whitespace"]) == []
+    finally:
+        diff_tree.close()
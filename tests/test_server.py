@@ -0,0 +1,34 @@
+import asyncio
+import logging
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from formast.server import handle_stream
+
+def handle(path):
+    time.sleep(0.01)
+
+def test_client_disconnecting(tmp_path, caplog):
+    async def main():
+        streams = []
+        with ProcessPoolExecutor(max_workers=2) as executor:
+            async def on_client(reader, writer):
+                streams.append(asyncio.current_task())
+                await handle_stream(reader, writer, executor, handle, 4)
+
+            address = str(tmp_path / "socket")
+            async with await asyncio.start_unix_server(on_client, address):
+                # Send a lot of requests and go away without reading the answers
+                _, writer = await asyncio.open_unix_connection(address)
+                writer.write(b"".join(b"/dev/null/%d\n" % i for i in range(200)))
+                await writer.drain()
+                writer.close()
+                while not streams:
+                    await asyncio.sleep(0.01)
+                await asyncio.wait_for(streams[0], 10)
+        # The stream stopped reading and writing as well
+        assert asyncio.all_tasks() == {asyncio.current_task()}
+
+    with caplog.at_level(logging.ERROR):
+        asyncio.run(main())
+    assert not [r for r in caplog.records if r.levelno >= logging.ERROR]
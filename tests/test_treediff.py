@@ -0,0 +1,39 @@
+import pytest
+from click.testing import CliRunner
+from tree_sitter import Parser
+
+from diffstat import main
+from formast.__main__ import JAVA_LANGUAGE
+from formast.treediff import TreeDiff, diff_sources
+
+A = b"class A {\n    int f() { return 1; }\n    int g() { return 2; }\n}\n"
+
+CASES = [
+    (A, A, TreeDiff(0, 0, 0)),
+    (A, b"class A { int f() {return 1;} int g() {return 2;} }", TreeDiff(0, 0, 0)),
+    (A, A.replace(b"}\n}", b"}\n    int h() { return 3; }\n}"), TreeDiff(1, 0, 0)),
+    (A, b"class A {\n    int f() { return 1; }\n}\n", TreeDiff(0, 1, 0)),
+    (A, b"class A {\n    int g() { return 2; }\n    int f() { return 1; }\n}\n", TreeDiff(0, 0, 1)),
+    # An edited leaf is deleted and inserted
+    (A, A.replace(b"return 1", b"return 5"), TreeDiff(1, 1, 0)),
+    (None, A, TreeDiff(1, 0, 0)),
+    (A, None, TreeDiff(0, 1, 0)),
+]
+
+@pytest.mark.parametrize("old, new, expected", CASES, ids=["same", "reformat", "insert", "delete", "move", "edit", "new", "removed"])
+def test_diff_sources(old, new, expected):
+    parser = Parser()
+    parser.set_language(JAVA_LANGUAGE)
+    assert diff_sources(parser, old, new) == expected
+
+def test_tree_output(java_repo, tmp_path):
+    path, commits = java_repo
+    output = tmp_path / "tree.csv"
+    result = CliRunner().invoke(main, [path, "--tree", str(output)], catch_exceptions=False)
+    assert result.exit_code == 0, result.output
+    assert output.read_text().splitlines() == [
+        "commit_hash,subtrees_inserted,subtrees_deleted,subtrees_moved,filename",
+        commits["move"] + ",0,0,1,Shop.java",
+        commits["add"] + ",1,0,0,Shop.java",
+        commits["reformat"] + ",0,0,0,Shop.java",
+    ]